@@ -1,5 +1,6 @@
 #!/bin/bash
 sudo python setup.py install
+python -m zeeguu.create_db
 touch zeeguu.wsgi
 
 
@@ -17,5 +17,6 @@ setuptools.setup(
     dependency_links=('http://github.com/zacharyvoase/cssmin/'
                       'tarball/master#egg=cssmin-0.1.4',),
     install_requires=("flask>=0.10.1", "Flask-SQLAlchemy", "Flask-Assets",
-                      "cssmin", "jsmin", "flask-wtf", "goslate", "MySQL-python")
+                      "cssmin", "jsmin", "flask-wtf", "goslate", "MySQL-python",
+                      "numpy")
 )
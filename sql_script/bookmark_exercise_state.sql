@@ -0,0 +1,7 @@
+-- It is executed for storing the running exercise state of every bookmark.
+-- Afterwards run populate_bookmark_state.py to backfill it from the exercise logs.
+
+ALTER TABLE bookmark
+ADD exercise_probability DECIMAL(10,9) NOT NULL DEFAULT 0.1,
+ADD correct_streak INT NOT NULL DEFAULT 0,
+ADD wrong_streak INT NOT NULL DEFAULT 0;
@@ -0,0 +1,5 @@
+-- It is executed for storing whether the latest decisive exercise outcome of every bookmark was too easy.
+-- Afterwards run populate_bookmark_state.py to backfill it from the exercise logs.
+
+ALTER TABLE bookmark
+ADD latest_outcome_too_easy BOOLEAN NOT NULL DEFAULT FALSE;
@@ -0,0 +1,3 @@
+-- It is executed for looking up the bookmarks of a user by learning state, newest first
+
+CREATE INDEX bookmark_user_state_time ON bookmark (user_id, latest_outcome_too_easy, time);
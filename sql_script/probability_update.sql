@@ -0,0 +1,11 @@
+-- It is executed for creating the queue of the update_probabilities worker
+
+CREATE TABLE probability_update
+(
+id INT NOT NULL PRIMARY KEY AUTO_INCREMENT,
+bookmark_id INT NOT NULL,
+user_id INT NOT NULL,
+time DATETIME NOT NULL,
+FOREIGN KEY (bookmark_id) REFERENCES bookmark(id) ON DELETE CASCADE,
+FOREIGN KEY (user_id) REFERENCES user(id)
+);
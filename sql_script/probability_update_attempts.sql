@@ -0,0 +1,5 @@
+-- It is executed for counting the failed attempts of the update_probabilities worker
+-- to process a queued update, after probability_update.sql
+
+ALTER TABLE probability_update
+ADD attempts INT NOT NULL DEFAULT 0;
@@ -44,8 +44,5 @@ env.append_path(os.path.join(
 ), "/static")
 
 db.init_app(app)
-db.create_all(app=app)
-
-from zeeguu.model import RankedWord
-with app.app_context():
-    RankedWord.cache_ranked_words()
+# Importing zeeguu does not touch the database: the schema is created
+# with create_db.py, and the rank tables are loaded on first use.
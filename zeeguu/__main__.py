@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 import zeeguu
+from zeeguu.create_db import create_db
 
 
 print "Instance folder:", zeeguu.app.instance_path
+# Importing zeeguu does not create the schema anymore
+create_db()
+# Forked before the server starts any threads
+zeeguu.api.endpoints.start_scoring_pool()
 zeeguu.app.run(
     host=zeeguu.app.config.get("HOST", "localhost"),
     port=zeeguu.app.config.get("PORT", 9000)
@@ -18,11 +18,9 @@ import zeeguu
 import json
 import datetime
 import re
-import time
-import Queue
-import threading
-from zeeguu.model import RankedWord, Language,Bookmark, Session, Search, UserWord, User, Url, KnownWordProbability, Text
+from zeeguu.model import RankedWord, Language,Bookmark, Session, Search, UserWord, User, Url, KnownWordProbability, Text, ProbabilityUpdate
 from zeeguu import util
+from zeeguu.api import translation as translation_service
 
 
 api = flask.Blueprint("api", __name__)
@@ -44,15 +42,30 @@ def with_session(view):
             session_id = int(flask.request.args['session'])
         except:
             flask.abort(401)
-        session = Session.query.get(session_id)
-        if session is None:
+        user = Session.find_user_cached(session_id)
+        if user is None:
             flask.abort(401)
-        flask.g.user = session.user
-        session.update_use_date()
+        flask.g.user = user
+        Session.record_use(session_id)
         return view(*args, **kwargs)
     return wrapped_view
 
 
+def json_list_response(items):
+    """
+    Responds with the items as a JSON list.
+
+    With ?stream=true the list is sent while the items are being
+    generated, instead of being built in memory first.
+    """
+    if flask.request.args.get('stream') == 'true':
+        return flask.Response(flask.stream_with_context(util.encode_stream(items)),
+                              status=200, mimetype='application/json')
+    js = json.dumps(list(items))
+    resp = flask.Response(js, status=200, mimetype='application/json')
+    return resp
+
+
 def cross_domain(view):
     """
     Decorator enables x-origin requests from any domain.
@@ -221,9 +234,7 @@ def studied_words():
     """
     Returns a list of the words that the user is currently studying.
     """
-    js = json.dumps(flask.g.user.user_words())
-    resp = flask.Response(js, status=200, mimetype='application/json')
-    return resp
+    return json_list_response(flask.g.user.iter_user_words())
 
 
 
@@ -237,54 +248,46 @@ def bookmarks_by_day(return_context):
     text where the bookmark was found. If <return_context>
     is anything else, the context is not returned.
 
+    The bookmarks can be fetched a few days at a time: ?limit=<n>
+    returns only the latest n days, and ?before=<iso_date> only the
+    days before the given one, e.g. the iso_date of the last day of
+    the previous page.
     """
     with_context = return_context == "with_context"
 
-
-    bookmarks_by_date, sorted_dates = flask.g.user.bookmarks_by_date()
-
-
-    dates = []
-    for date in sorted_dates:
-        bookmarks = []
-        for b in bookmarks_by_date[date]:
-            bookmark = {}
-            bookmark['id'] = b.id
-            bookmark['from'] = b.origin.word
-            bookmark['to'] = b.translation_words_list()
-            bookmark['from_lang'] = b.origin.language_id
-            bookmark['to_lang'] = b.translation().language.id
-            bookmark['title'] = b.text.url.title
-            bookmark['url'] = b.text.url.url
-
-            if with_context:
-                bookmark['context'] = b.text.content
-            bookmarks.append(bookmark)
-        date_entry = {}
-        date_entry['date'] = date.strftime("%A, %d %B")
-        date_entry['bookmarks'] = bookmarks
-        dates.append(date_entry)
-
-    js = json.dumps(dates)
-    resp = flask.Response(js, status=200, mimetype='application/json')
-    return resp
-
-def translate_from_to (word, from_lang_code,to_lang_code):
-	translate_url = "https://www.googleapis.com/language/translate/v2"
-	api_key = zeeguu.app.config.get("TRANSLATE_API_KEY")
-
-	# Note, that there is quote and quote_plus. The Google API prefers quote_plus,
-	# This seems to be the convention for info submitted from forms via GET.
-	url = translate_url + \
-		"?q="+ word +\
-		"&target="+to_lang_code.encode('utf8')+\
-		"&format=text".encode('utf8')+\
-		"&source="+from_lang_code.encode('utf8')+\
-		"&key="+api_key
-	print url
-	result=json.loads(urllib2.urlopen(url).read())
-	translation = result['data']['translations'][0]['translatedText']
-	return translation
+    before = flask.request.args.get('before', None)
+    if before is not None:
+        try:
+            before = datetime.datetime.strptime(before, "%Y-%m-%d")
+        except ValueError:
+            return "FAIL"
+    limit = flask.request.args.get('limit', None, type=int)
+
+    bookmarks_by_date, sorted_dates = flask.g.user.bookmarks_by_date(before, limit)
+
+    def date_entries():
+        for date in sorted_dates:
+            bookmarks = []
+            for b in bookmarks_by_date[date]:
+                bookmark = {}
+                bookmark['id'] = b.id
+                bookmark['from'] = b.origin.word
+                bookmark['to'] = b.translation_words_list()
+                bookmark['from_lang'] = b.origin.language_id
+                bookmark['to_lang'] = b.translation().language_id
+                bookmark['title'] = b.text.url.title
+                bookmark['url'] = b.text.url.url
+
+                if with_context:
+                    bookmark['context'] = b.text.content
+                bookmarks.append(bookmark)
+            date_entry = {}
+            date_entry['date'] = date.strftime("%A, %d %B")
+            date_entry['iso_date'] = date.strftime("%Y-%m-%d")
+            date_entry['bookmarks'] = bookmarks
+            yield date_entry
+
+    return json_list_response(date_entries())
 
 @api.route ("/translate/<from_lang_code>/<to_lang_code>", methods=["POST"])
 @cross_domain
@@ -301,7 +304,7 @@ def translate(from_lang_code,to_lang_code):
     url = flask.request.form.get('url','')
     word = flask.request.form['word']
     word = re.sub(r'%20', "+", word)
-    return translate_from_to(word, from_lang_code, to_lang_code)
+    return translation_service.translate(word, from_lang_code, to_lang_code)
 
 
 
@@ -348,7 +351,12 @@ def bookmark_with_context(from_lang_code, term, to_lang_code, translation):
     new_text = Text(context, from_lang, url)
     bookmark = Bookmark(user_word, translation, flask.g.user, new_text, datetime.datetime.now())
     zeeguu.db.session.add(bookmark)
-    bookmark.calculate_probabilities_after_adding_a_bookmark(flask.g.user, bookmark.origin.language)
+    if zeeguu.app.config.get("ASYNC_PROBABILITY_UPDATES"):
+        # the update_probabilities worker takes it from here
+        zeeguu.db.session.add(ProbabilityUpdate(bookmark))
+        zeeguu.db.session.commit()
+    else:
+        bookmark.calculate_probabilities_after_adding_a_bookmark(flask.g.user, bookmark.origin.language)
     return str(bookmark.id)
 
 
@@ -460,13 +468,14 @@ def get_translations_for_bookmark(bookmark_id):
     resp = flask.Response(js, status=200, mimetype='application/json')
     return resp
 
+# the words can be paged through with e.g. ?offset=100&limit=100
 @api.route("/get_not_encountered_words/<lang_code>", methods=("GET",))
 @cross_domain
 @with_session
 def get_not_encountered_words(lang_code):
-    js = json.dumps(flask.g.user.get_not_encountered_words(Language.find(lang_code)))
-    resp = flask.Response(js, status=200, mimetype='application/json')
-    return resp
+    offset = flask.request.args.get('offset', 0, type=int)
+    limit = flask.request.args.get('limit', None, type=int)
+    return json_list_response(flask.g.user.iter_not_encountered_words(Language.find(lang_code), offset, limit))
 
 @api.route("/get_known_bookmarks/<lang_code>", methods=("GET",))
 @cross_domain
@@ -482,18 +491,10 @@ def get_known_bookmarks(lang_code):
 @with_session
 def get_known_words(lang_code):
     lang_id = Language.find(lang_code)
-    bookmarks = flask.g.user.all_bookmarks()
-    known_words=[]
-    filtered_known_words_from_user = []
+    bookmarks = Bookmark.find_by_user_and_state(flask.g.user, True)
+    known_words = set(word for (word,) in bookmarks.join(UserWord, Bookmark.origin).with_entities(UserWord.word))
+    filtered_known_words_from_user = list(RankedWord.exists_many(known_words, lang_id))
     filtered_known_words_dict_list =[]
-    for bookmark in bookmarks:
-        if bookmark.check_is_latest_outcome_too_easy():
-                known_words.append(bookmark.origin.word)
-    for word_known in known_words:
-        if RankedWord.exists(word_known, lang_id):
-            filtered_known_words_from_user.append(word_known)
-            zeeguu.db.session.commit()
-    filtered_known_words_from_user = list(set(filtered_known_words_from_user))
     for word in filtered_known_words_from_user:
         filtered_known_words_dict_list.append( {'word': word} )
     js = json.dumps(filtered_known_words_dict_list)
@@ -504,9 +505,7 @@ def get_known_words(lang_code):
 @cross_domain
 @with_session
 def get_probably_known_words(lang_code):
-    js = json.dumps(flask.g.user.get_probably_known_words(Language.find(lang_code)))
-    resp = flask.Response(js, status=200, mimetype='application/json')
-    return resp
+    return json_list_response(flask.g.user.iter_probably_known_words(Language.find(lang_code)))
 
 @api.route("/get_lower_bound_percentage_of_basic_vocabulary", methods=("GET",))
 @cross_domain
@@ -540,26 +539,33 @@ def get_upper_bound_percentage_of_extended_vocabulary():
 def get_percentage_of_probably_known_bookmarked_words():
     return flask.g.user.get_percentage_of_probably_known_bookmarked_words()
 
+# returns all the vocabulary percentages above at once. The rank thresholds
+# of the vocabularies can be given as e.g. ?rank_thresholds=3000,10000
+@api.route("/get_vocabulary_statistics", methods=("GET",))
+@cross_domain
+@with_session
+def get_vocabulary_statistics():
+    rank_thresholds = flask.request.args.get('rank_thresholds')
+    if rank_thresholds:
+        try:
+            rank_thresholds = [int(threshold) for threshold in rank_thresholds.split(',')]
+        except ValueError:
+            return "FAIL"
+        statistics = flask.g.user.vocabulary_statistics(rank_thresholds)
+    else:
+        statistics = flask.g.user.vocabulary_statistics()
+    js = json.dumps(statistics)
+    resp = flask.Response(js, status=200, mimetype='application/json')
+    return resp
+
+# the bookmarks can be paged through with e.g. ?offset=100&limit=100
 @api.route("/get_learned_bookmarks/<lang>", methods=("GET",))
 @cross_domain
 @with_session
 def get_learned_bookmarks(lang):
-    lang = Language.find(lang)
-    bookmarks = flask.g.user.all_bookmarks()
-    too_easy_bookmarks=[]
-    learned_bookmarks_dict_list =[]
-    for bookmark in bookmarks:
-        if bookmark.check_is_latest_outcome_too_easy() and bookmark.origin.language == lang:
-                too_easy_bookmarks.append(bookmark)
-    learned_bookmarks= [bookmark for bookmark in bookmarks if bookmark not in too_easy_bookmarks]
-    for bookmark in learned_bookmarks:
-        learned_bookmarks_dict = {}
-        learned_bookmarks_dict ['id'] = bookmark.id
-        learned_bookmarks_dict ['origin'] = bookmark.origin.word
-        learned_bookmarks_dict['text'] = bookmark.text.content
-        learned_bookmarks_dict_list.append(learned_bookmarks_dict)
-
-    js = json.dumps(learned_bookmarks_dict_list)
+    offset = flask.request.args.get('offset', 0, type=int)
+    limit = flask.request.args.get('limit', None, type=int)
+    js = json.dumps(flask.g.user.get_learned_bookmarks(Language.find(lang), offset, limit))
     resp = flask.Response(js, status=200, mimetype='application/json')
     return resp
 
@@ -572,6 +578,76 @@ def get_not_looked_up_words(lang_code):
     return resp
 
 
+def is_true(value):
+    return str(value).lower() not in ('false', '0')
+
+
+def difficulty_options(data):
+    """
+    :return: dict with the personalized, rank_boundary, histogram_bins and
+        approximate_median options of a difficulty request for
+        util.text_difficulties, with their defaults, or None if they are invalid
+    """
+    personalized = True
+    if 'personalized' in data:
+        personalized = is_true(data['personalized'])
+
+    rank_boundary = 10000.0
+    if 'rank_boundary' in data:
+        rank_boundary = float(data['rank_boundary'])
+        if rank_boundary > 10000.0:
+            rank_boundary = 10000.0
+
+    histogram_bins = None
+    if 'histogram_bins' in data:
+        histogram_bins = int(data['histogram_bins'])
+        if not 1 <= histogram_bins <= util.scoring.MAX_HISTOGRAM_BINS:
+            return None
+
+    approximate_median = False
+    if 'approximate_median' in data:
+        approximate_median = is_true(data['approximate_median'])
+
+    return dict(personalized=personalized, rank_boundary=rank_boundary,
+                histogram_bins=histogram_bins, approximate_median=approximate_median)
+
+
+# Process pool for the difficulty of large batches of texts, see start_scoring_pool
+scoring_pool = None
+
+
+def start_scoring_pool():
+    """
+    Starts the scoring pool if PARALLEL_SCORING_PROCESSES and RANK_TABLE_DIRECTORY
+    are set. Must be called when the server is loaded, before it starts any threads.
+    """
+    global scoring_pool
+    config = zeeguu.app.config
+    if config.get("PARALLEL_SCORING_PROCESSES") and config.get("RANK_TABLE_DIRECTORY") and scoring_pool is None:
+        scoring_pool = util.ScoringPool(config.get("PARALLEL_SCORING_PROCESSES"))
+
+
+def score_text_difficulties(texts, language, known_probabilities, options):
+    """
+    Computes the text difficulties in the scoring pool for batches that are
+    large enough, and in the request thread otherwise, or when the pool does
+    not answer in time or does not have the current rank table file.
+    """
+    rank_table = RankedWord.rank_table(language)
+
+    config = zeeguu.app.config
+    if scoring_pool is not None and (len(texts) >= config.get("PARALLEL_SCORING_MIN_TEXTS") or
+                                     sum(len(text['content']) for text in texts) >= config.get("PARALLEL_SCORING_MIN_SIZE")):
+        rank_table_path = RankedWord.rank_table_path(config.get("RANK_TABLE_DIRECTORY"), language.id)
+        difficulties = scoring_pool.text_difficulties(texts, rank_table_path, rank_table.fingerprint,
+                                                      known_probabilities, config.get("PARALLEL_SCORING_TIMEOUT"),
+                                                      **options)
+        if difficulties is not None:
+            return difficulties
+
+    return util.text_difficulties(texts, rank_table, known_probabilities, **options)
+
+
 @api.route("/get_difficulty_for_text/<lang_code>", methods=("POST",))
 @cross_domain
 @with_session
@@ -585,6 +661,10 @@ def get_difficulty_for_text(lang_code):
         with the text itself as 'content' and an additional 'id' which gets roundtripped unchanged
     :param personalized (optional): calculate difficulty score for a specific user? (Enabled by default)
     :param rank_boundary (optional): upper boundary for word frequency rank (between 1 and 10'000)
+    :param histogram_bins (optional): also return for every text the 'histogram' of the difficulties
+        of its words, counted in this many (at most 100) equally wide ranges between 0 and 1
+    :param approximate_median (optional): estimate the medians from a histogram of the word difficulties
+        instead of sorting them, within 0.001 of the exact median (Disabled by default)
 
     :return difficulties: json array, contains the difficulties as arrays with the key 'score_median' for the median
         and 'score_average' for the average difficulty the value (between 0 (easy) and 1 (hard)) and the 'id' parameter
@@ -603,57 +683,14 @@ def get_difficulty_for_text(lang_code):
     else:
         return 'FAIL'
 
-    personalized = True
-    if 'personalized' in data:
-        personalized = data['personalized'].lower()
-        if personalized == 'false' or personalized == '0':
-            personalized = False
-
-    rank_boundary = 10000.0
-    if 'rank_boundary' in data:
-        rank_boundary = float(data['rank_boundary'])
-        if rank_boundary > 10000.0:
-            rank_boundary = 10000.0
+    options = difficulty_options(data)
+    if options is None:
+        return 'FAIL'
 
     user = flask.g.user
     known_probabilities = KnownWordProbability.find_all_by_user_cached(user)
 
-    difficulties = []
-    for text in texts:
-        # Calculate difficulty for each word
-        words = util.split_words_from_text(text['content'])
-        words_difficulty = []
-        for word in words:
-            ranked_word = RankedWord.find_cache(word, language)
-
-            word_difficulty = 1.0 # Value between 0 (easy) and 1 (hard)
-            if ranked_word is not None:
-                # Check if the user knows the word
-                try:
-                    known_propability = known_probabilities[word] # Value between 0 (unknown) and 1 (known)
-                except KeyError:
-                    known_propability = None
-
-                if personalized and known_propability is not None:
-                    word_difficulty -= float(known_propability)
-                elif ranked_word.rank <= rank_boundary:
-                    word_frequency = (rank_boundary-(ranked_word.rank-1))/rank_boundary # Value between 0 (rare) and 1 (frequent)
-                    word_difficulty -= word_frequency
-
-            words_difficulty.append(word_difficulty)
-
-        # Uncomment to print data for histogram generation
-        #text.generate_histogram(words_difficulty)
-
-        # Median difficulty for text
-        words_difficulty.sort()
-        center = int(round(len(words_difficulty)/2, 0))
-        difficulty_median = words_difficulty[center]
-
-        # Average difficulty for text
-        difficulty_average = sum(words_difficulty) / float(len(words_difficulty))
-
-        difficulties.append(dict(score_median=difficulty_median, score_average=difficulty_average, id=text['id']))
+    difficulties = score_text_difficulties(texts, language, known_probabilities, options)
 
     response = json.dumps(dict(difficulties=difficulties))
 
@@ -692,33 +729,67 @@ def get_learnability_for_text(lang_code):
     user = flask.g.user
 
     # Get the words the user is currently learning
-    words_learning = {}
-    bookmarks = Bookmark.find_by_specific_user(user)
-    for bookmark in bookmarks:
-        learning = not bookmark.check_is_latest_outcome_too_easy()
-        user_word = bookmark.origin
-        if learning and user_word.language == language:
-            words_learning[user_word.word] = user_word.word
-
-    learnabilities = []
-    for text in texts:
-        # Calculate learnability
-        words = util.split_words_from_text(text['content'])
-        words_learnability = []
-        for word in words:
-            if word in words_learning:
-                words_learnability.append(word)
-
-        count = len(words_learnability)
-        learnability = count / float(len(words))
-
-        learnabilities.append(dict(score=learnability, count=count, id=text['id']))
+    words_learning = Bookmark.find_learning_words_cached(user, language)
+
+    learnabilities = util.text_learnabilities(texts, words_learning)
 
     response = json.dumps(dict(learnabilities=learnabilities))
 
     return flask.Response(response, status=200, mimetype='application/json')
 
 
+@api.route("/get_scores_for_text/<lang_code>", methods=("POST",))
+@cross_domain
+@with_session
+def get_scores_for_text(lang_code):
+    """
+    Calculates both the difficulty and the learnability of the texts,
+    splitting every text into words only once.
+
+    URL parameters:
+    :param lang_code: the language of the text
+
+    Json data:
+    :param texts: json array that contains the texts to score. Each text consists of an array
+        with the text itself as 'content' and an additional 'id' which gets roundtripped unchanged
+    :param personalized (optional): calculate difficulty score for a specific user? (Enabled by default)
+    :param rank_boundary (optional): upper boundary for word frequency rank (between 1 and 10'000)
+    :param histogram_bins (optional): also return for every text the 'histogram' of the difficulties
+        of its words, counted in this many (at most 100) equally wide ranges between 0 and 1
+    :param approximate_median (optional): estimate the medians instead of sorting the word difficulties
+
+    :return: json with the 'difficulties' and the 'learnabilities' of the texts, as returned by
+        /get_difficulty_for_text and /get_learnability_for_text
+    """
+    language = Language.find(lang_code)
+    if language is None:
+        return 'FAIL'
+
+    data = flask.request.get_json()
+
+    if 'texts' in data:
+        texts = list(data['texts'])
+    else:
+        return 'FAIL'
+
+    options = difficulty_options(data)
+    if options is None:
+        return 'FAIL'
+
+    user = flask.g.user
+    words_of_texts = util.split_words_from_texts(texts)
+
+    difficulties = util.text_difficulties(texts, RankedWord.rank_table(language),
+                                          KnownWordProbability.find_all_by_user_cached(user),
+                                          words_of_texts=words_of_texts, **options)
+    learnabilities = util.text_learnabilities(texts, Bookmark.find_learning_words_cached(user, language),
+                                              words_of_texts)
+
+    response = json.dumps(dict(difficulties=difficulties, learnabilities=learnabilities))
+
+    return flask.Response(response, status=200, mimetype='application/json')
+
+
 @api.route("/get_content_from_url", methods=("POST",))
 @cross_domain
 def get_content_from_url():
@@ -733,7 +804,6 @@ def get_content_from_url():
         to identify the corresponding url
     """
     data = flask.request.get_json()
-    queue = Queue.Queue()
 
     urls = []
     if 'urls' in data:
@@ -747,31 +817,26 @@ def get_content_from_url():
     else:
         timeout = 10
 
-    # Start worker threads to get url contents
-    threads = []
-    for url in urls:
-        thread = threading.Thread(target=util.PageExtractor.worker, args=(url['url'], url['id'], queue))
-        thread.daemon = True
-        threads.append(thread)
-        thread.start()
-
-    # Wait for workers to finish until timeout
-    stop = time.time() + timeout
-    while any(t.isAlive() for t in threads) and time.time() < stop:
-        time.sleep(0.1)
-
-    contents = []
-    for i in xrange(len(urls)):
-        try:
-            contents.append(queue.get_nowait())
-        except Queue.Empty:
-            pass
+    contents = util.PageExtractor.extract_all(urls, timeout)
 
     response = json.dumps(dict(contents=contents))
 
     return flask.Response(response, status=200, mimetype='application/json')
 
 
+@api.route("/article_cache_stats", methods=("GET",))
+@cross_domain
+def article_cache_stats():
+    """
+    :return: json object with the number of 'articles' in the cache of get_content_from_url,
+        their 'size' and the 'max_size' in bytes, and the cache 'hits', 'misses' and 'revalidations'
+    """
+    stats = {}
+    if util.PageExtractor.cache is not None:
+        stats = util.PageExtractor.cache.stats()
+    return flask.Response(json.dumps(stats), status=200, mimetype='application/json')
+
+
 @api.route("/lookup/<from_lang>/<term>/<to_lang>", methods=("POST",))
 @cross_domain
 @with_session
@@ -798,7 +863,6 @@ def lookup(from_lang, term, to_lang):
     else:
         text = None
     word = decode_word(term)
-    rank = UserWord.find_rank(word, to_lang)
     user.searches.append(
         Search(user, UserWord.find(word, from_lang),
                      to_lang, text)
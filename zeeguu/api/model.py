@@ -1,7 +1,11 @@
 # -*- coding: utf8 -*-
+import os
 import re
 import random
 import datetime
+import time
+import threading
+import atexit
 import string
 import decimal
 import flask
@@ -9,11 +13,12 @@ from sqlalchemy import Column, Table, ForeignKey, Integer, DECIMAL
 from re import compile as _Re
 
 import sqlalchemy.orm.exc
+import sqlalchemy.event
 
 from zeeguu import db
 from zeeguu import util
 import zeeguu
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, joinedload, subqueryload
 starred_words_association_table = Table('starred_words_association', db.Model.metadata,
     Column('user_id', Integer, ForeignKey('user.id')),
     Column('starred_word_id', Integer, ForeignKey('user_word.id'))
@@ -118,8 +123,20 @@ class User(db.Model):
     def bookmarks_chronologically(self):
 	    return Bookmark.query.filter_by(user_id=self.id).order_by(Bookmark.time.desc()).all()
 
+    # Rows fetched at a time by the iter_* methods, which read
+    # from a server side cursor for streamed responses
+    STREAM_BATCH_SIZE = 1000
+
+    def iter_user_words(self):
+        words = db.session.query(UserWord.word)\
+            .join(Bookmark, Bookmark.origin_id == UserWord.id)\
+            .filter(Bookmark.user_id == self.id)\
+            .order_by(Bookmark.time.desc())
+        for (word,) in words.execution_options(stream_results=True).yield_per(self.STREAM_BATCH_SIZE):
+            yield word
+
     def user_words(self):
-        return map((lambda x: x.origin.word), self.all_bookmarks())
+        return list(self.iter_user_words())
 
     def all_bookmarks(self):
         return Bookmark.query.filter_by(user_id=self.id).order_by(Bookmark.time.desc()).all()
@@ -131,14 +148,50 @@ class User(db.Model):
         return len(self.user_words())
 
 
-    def bookmarks_by_date(self):
+    def bookmark_feed(self, before=None):
+        """
+        :param before: only bookmarks older than this datetime
+        :return: query for the bookmarks of the user, newest first, which loads
+            their origin, translations, text and url together with them
+        """
+        query = Bookmark.query.filter_by(user_id=self.id)\
+            .options(joinedload(Bookmark.origin),
+                     subqueryload(Bookmark.translations_list),
+                     joinedload(Bookmark.text).joinedload(Text.url))
+        if before is not None:
+            query = query.filter(Bookmark.time < before)
+        return query.order_by(Bookmark.time.desc())
+
+    def bookmarks_by_date(self, before=None, day_count=None):
+        """
+        :param before: only bookmarks older than this datetime
+        :param day_count: only the bookmarks of the latest day_count days
+            (before the given datetime) which have bookmarks
+        :return: (dict mapping days to their bookmarks, days newest first)
+        """
         def extract_day_from_date(bookmark):
     		return (bookmark, bookmark.time.replace(bookmark.time.year, bookmark.time.month, bookmark.time.day,0,0,0,0))
 
-        bookmarks = self.all_bookmarks()
+        bookmarks = self.bookmark_feed(before)
+        if day_count is not None:
+            # Find the oldest day of the page by scanning only the times
+            times = db.session.query(Bookmark.time).filter(Bookmark.user_id == self.id)
+            if before is not None:
+                times = times.filter(Bookmark.time < before)
+            days = []
+            for (bookmark_time,) in times.order_by(Bookmark.time.desc()):
+                day = bookmark_time.replace(hour=0, minute=0, second=0, microsecond=0)
+                if not days or days[-1] != day:
+                    if len(days) == day_count:
+                        break
+                    days.append(day)
+            if not days:
+                return dict(), []
+            bookmarks = bookmarks.filter(Bookmark.time >= days[-1])
+
         bookmarks_by_date = dict()
 
-        for elem in map(extract_day_from_date, bookmarks):
+        for elem in map(extract_day_from_date, bookmarks.all()):
             bookmarks_by_date.setdefault(elem[1],[]).append(elem[0])
 
         sorted_dates = bookmarks_by_date.keys()
@@ -184,43 +237,68 @@ class User(db.Model):
                 urls_to_words [bookmark.text.url] += bookmark.origin.importance_level()
         return sorted(urls_to_words, key=urls_to_words.get, reverse=True)
 
-    def get_not_encountered_words(self, lang):
-        not_encountered_words_dict_list = []
-        all_ranks = RankedWord.find_all(lang)
-        known_word_probs = KnownWordProbability.find_all_by_user_with_rank(self)
-        for p in known_word_probs:
-            if p.ranked_word in all_ranks:
-                all_ranks.remove(p.ranked_word)
-        for rank in all_ranks:
-            not_encountered_word_dict = {}
-            not_encountered_word_dict['word'] = rank.word
-            not_encountered_words_dict_list.append(not_encountered_word_dict)
-        return not_encountered_words_dict_list
-
-
+    def not_encountered_words_query(self, lang):
+        """
+        :return: query for the ranked words of the language for which the
+            user has no known word probability, most frequent first
+        """
+        encountered = sqlalchemy.exists().where(sqlalchemy.and_(
+            KnownWordProbability.user_id == self.id,
+            KnownWordProbability.ranked_word_id == RankedWord.id))
+        return RankedWord.query.filter(RankedWord.language == lang)\
+            .filter(~encountered)\
+            .order_by(RankedWord.rank, RankedWord.id)
+
+    def iter_not_encountered_words(self, lang, offset=0, limit=None):
+        query = self.not_encountered_words_query(lang).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        words = query.with_entities(RankedWord.word)
+        for (word,) in words.execution_options(stream_results=True).yield_per(self.STREAM_BATCH_SIZE):
+            yield {'word': word}
+
+    def get_not_encountered_words(self, lang, offset=0, limit=None):
+        return list(self.iter_not_encountered_words(lang, offset, limit))
 
     def get_not_encountered_words_count(self):
-        return len(self.get_not_encountered_words(self.learned_language))
-
-
+        return self.not_encountered_words_query(self.learned_language).order_by(None).count()
 
 
 
     def get_known_bookmarks(self,lang):
-        bookmarks = flask.g.user.all_bookmarks()
+        bookmarks = Bookmark.find_by_user_and_state(self, True, lang)\
+            .options(joinedload(Bookmark.origin), joinedload(Bookmark.text))
         known_bookmarks=[]
         for bookmark in bookmarks:
-            if bookmark.check_is_latest_outcome_too_easy() and lang ==bookmark.origin.language:
-                    known_bookmark_dict = {
-                        'id': bookmark.id,
-                        'origin': bookmark.origin.word,
-                        'text': bookmark.text.content,
-                        'time': bookmark.time.strftime('%m/%d/%Y')}
-                    known_bookmarks.append(known_bookmark_dict)
+            known_bookmark_dict = {
+                'id': bookmark.id,
+                'origin': bookmark.origin.word,
+                'text': bookmark.text.content,
+                'time': bookmark.time.strftime('%m/%d/%Y')}
+            known_bookmarks.append(known_bookmark_dict)
         return known_bookmarks
 
+    def get_learned_bookmarks(self, lang, offset=0, limit=None):
+        """
+        :return: the bookmarks of words in the language which the user is
+            still learning, i.e. whose latest decisive outcome was not too easy,
+            newest first
+        """
+        bookmarks = Bookmark.find_by_user_and_state(self, False, lang)\
+            .options(joinedload(Bookmark.origin), joinedload(Bookmark.text))\
+            .offset(offset)
+        if limit is not None:
+            bookmarks = bookmarks.limit(limit)
+        learned_bookmarks = []
+        for bookmark in bookmarks:
+            learned_bookmarks.append({
+                'id': bookmark.id,
+                'origin': bookmark.origin.word,
+                'text': bookmark.text.content})
+        return learned_bookmarks
+
     def get_known_bookmarks_count(self):
-        return len(self.get_known_bookmarks(self.learned_language))
+        return Bookmark.find_by_user_and_state(self, True, self.learned_language).count()
 
 
     def get_not_looked_up_words(self, lang):
@@ -240,65 +318,89 @@ class User(db.Model):
         return len(self.get_not_looked_up_words_for_learned_language())
 
 
-    def get_probably_known_words(self, lang):
-        known_word_prob_of_user = KnownWordProbability.get_probably_known_words(self)
-        probable_known_words_dict_list = []
-        for known_word_prob in known_word_prob_of_user:
-            probable_known_word_dict = {}
-            if known_word_prob.ranked_word is not None and known_word_prob.ranked_word.language == lang:
-                probable_known_word_dict['word'] = known_word_prob.ranked_word.word
+    def iter_probably_known_words(self, lang):
+        words = db.session.query(RankedWord.word, RankedWord.language_id, UserWord.word)\
+            .select_from(KnownWordProbability)\
+            .outerjoin(RankedWord, KnownWordProbability.ranked_word_id == RankedWord.id)\
+            .outerjoin(UserWord, KnownWordProbability.user_word_id == UserWord.id)\
+            .filter(KnownWordProbability.user_id == self.id)\
+            .filter(KnownWordProbability.probability >= 0.9)
+        for ranked_word, ranked_word_language_id, user_word in \
+                words.execution_options(stream_results=True).yield_per(self.STREAM_BATCH_SIZE):
+            if ranked_word is not None and ranked_word_language_id == lang.id:
+                yield {'word': ranked_word}
             else:
-                probable_known_word_dict['word'] = known_word_prob.user_word.word
-            probable_known_words_dict_list.append(probable_known_word_dict)
-        return probable_known_words_dict_list
+                yield {'word': user_word}
+
+    def get_probably_known_words(self, lang):
+        return list(self.iter_probably_known_words(lang))
 
     def get_probably_known_words_count(self):
         return len(self.get_probably_known_words(self.learned_language))
 
+    BASIC_VOCABULARY_SIZE = 3000
+    EXTENDED_VOCABULARY_SIZE = 10000
+
+    def vocabulary_statistics(self, rank_thresholds=(BASIC_VOCABULARY_SIZE, EXTENDED_VOCABULARY_SIZE)):
+        """
+        Estimates how much of the most frequent words the user knows,
+        with one aggregate query per probability table.
+
+        :param rank_thresholds: sizes of the vocabularies, in frequency rank
+        :return: dict with
+            'lower_bounds': dict threshold -> percentage of the words up to
+                that rank which the user probably knows
+            'upper_bounds': dict threshold -> percentage of the words up to
+                that rank which the user encountered without looking them up
+            'probably_known_bookmarked_words': percentage of the bookmarks
+                of the user whose word is probably known
+        """
+        def count_up_to(threshold):
+            return sqlalchemy.func.sum(sqlalchemy.case([(RankedWord.rank <= threshold, 1)], else_=0))
+
+        known_counts = db.session.query(
+                sqlalchemy.func.count(KnownWordProbability.user_word_id),
+                *[count_up_to(threshold) for threshold in rank_thresholds]
+            ).select_from(KnownWordProbability)\
+            .outerjoin(RankedWord, KnownWordProbability.ranked_word_id == RankedWord.id)\
+            .filter(KnownWordProbability.user_id == self.id)\
+            .filter(KnownWordProbability.probability >= 0.9).one()
+
+        encountered_counts = []
+        if rank_thresholds:
+            encountered_counts = db.session.query(
+                    *[count_up_to(threshold) for threshold in rank_thresholds]
+                ).select_from(EncounterBasedProbability)\
+                .join(RankedWord, EncounterBasedProbability.ranked_word_id == RankedWord.id)\
+                .filter(EncounterBasedProbability.user_id == self.id).one()
+
+        def percentage(count, total):
+            if total == 0:
+                return 0
+            return round(float(count or 0)/total*100, 2)
+
+        bookmark_count = Bookmark.query.filter_by(user_id=self.id).count()
+        return dict(
+            lower_bounds=dict((threshold, percentage(count, threshold))
+                              for threshold, count in zip(rank_thresholds, known_counts[1:])),
+            upper_bounds=dict((threshold, percentage(count, threshold))
+                              for threshold, count in zip(rank_thresholds, encountered_counts)),
+            probably_known_bookmarked_words=percentage(known_counts[0], bookmark_count))
+
     def get_lower_bound_percentage_of_basic_vocabulary(self):
-        high_known_word_prob_of_user = KnownWordProbability.get_probably_known_words(self)
-        count_high_known_word_prob_of_user_ranked = 0
-        for prob in high_known_word_prob_of_user:
-            if prob.ranked_word is not None and prob.ranked_word.rank <=3000:
-                count_high_known_word_prob_of_user_ranked +=1
-        return round(float(count_high_known_word_prob_of_user_ranked)/3000*100,2)
+        return self.vocabulary_statistics([self.BASIC_VOCABULARY_SIZE])['lower_bounds'][self.BASIC_VOCABULARY_SIZE]
 
     def get_upper_bound_percentage_of_basic_vocabulary(self):
-        count_not_looked_up_words_with_rank = 0
-        not_looked_up_words = EncounterBasedProbability.find_all_by_user(self)
-        for prob in not_looked_up_words:
-            if prob.ranked_word.rank <=3000:
-                count_not_looked_up_words_with_rank +=1
-        return round(float(count_not_looked_up_words_with_rank)/3000*100,2)
+        return self.vocabulary_statistics([self.BASIC_VOCABULARY_SIZE])['upper_bounds'][self.BASIC_VOCABULARY_SIZE]
 
     def get_lower_bound_percentage_of_extended_vocabulary(self):
-        high_known_word_prob_of_user = KnownWordProbability.get_probably_known_words(self)
-        count_high_known_word_prob_of_user_ranked = 0
-        for prob in high_known_word_prob_of_user:
-            if prob.ranked_word is not None and prob.ranked_word.rank <=10000:
-                count_high_known_word_prob_of_user_ranked +=1
-        return round(float(count_high_known_word_prob_of_user_ranked)/10000*100,2)
+        return self.vocabulary_statistics([self.EXTENDED_VOCABULARY_SIZE])['lower_bounds'][self.EXTENDED_VOCABULARY_SIZE]
 
     def get_upper_bound_percentage_of_extended_vocabulary(self):
-        count_not_looked_up_words_with_rank = 0
-        not_looked_up_words = EncounterBasedProbability.find_all_by_user(self)
-        for prob in not_looked_up_words:
-            if prob.ranked_word.rank <=10000:
-                count_not_looked_up_words_with_rank +=1
-        return round(float(count_not_looked_up_words_with_rank)/10000*100,2)
-
+        return self.vocabulary_statistics([self.EXTENDED_VOCABULARY_SIZE])['upper_bounds'][self.EXTENDED_VOCABULARY_SIZE]
 
     def get_percentage_of_probably_known_bookmarked_words(self):
-        high_known_word_prob_of_user = KnownWordProbability.get_probably_known_words(self)
-        count_high_known_word_prob_of_user =0
-        count_bookmarks_of_user = len(self.all_bookmarks())
-        for prob in high_known_word_prob_of_user:
-            if prob.user_word is not None:
-                count_high_known_word_prob_of_user +=1
-        if count_bookmarks_of_user <> 0:
-            return round(float(count_high_known_word_prob_of_user)/count_bookmarks_of_user*100,2)
-        else:
-            return 0
+        return self.vocabulary_statistics([])['probably_known_bookmarked_words']
 
 
 
@@ -328,6 +430,16 @@ class Session(db.Model):
     user = db.relationship("User")
     last_use = db.Column(db.DateTime)
 
+    # session id -> user id. The user itself is loaded by every request,
+    # so changes made by other processes are seen at once
+    user_ids_cache = util.LRUCache(10000, time_to_live=300)
+
+    # session id -> last use, waiting to be written to the database
+    pending_use_dates = {}
+    pending_use_dates_lock = threading.Lock()
+    use_dates_writer = None
+    USE_DATES_WRITE_INTERVAL = 60
+
     def __init__(self, user, id_):
         self.id = id_
         self.user = user
@@ -344,6 +456,55 @@ class Session(db.Model):
                 break
         return cls(user, id_)
 
+    @classmethod
+    def find_user_cached(cls, session_id):
+        """
+        :return: the user of the session, or None if there is no such session
+        """
+        user_id = cls.user_ids_cache.get(session_id)
+        if user_id is None:
+            session = cls.query.get(session_id)
+            if session is None:
+                return None
+            user_id = session.user_id
+            cls.user_ids_cache.put(session_id, user_id)
+        return User.query.get(user_id)
+
+    @classmethod
+    def record_use(cls, session_id):
+        """
+        Remembers that the session was used now. The use dates are written
+        to the database in the background, at most once per interval.
+        """
+        with cls.pending_use_dates_lock:
+            cls.pending_use_dates[session_id] = datetime.datetime.now()
+            if cls.use_dates_writer is None:
+                cls.use_dates_writer = threading.Thread(target=cls._write_use_dates_periodically)
+                cls.use_dates_writer.daemon = True
+                cls.use_dates_writer.start()
+                atexit.register(cls.write_use_dates)
+
+    @classmethod
+    def write_use_dates(cls):
+        with cls.pending_use_dates_lock:
+            use_dates, cls.pending_use_dates = cls.pending_use_dates, {}
+        if not use_dates:
+            return
+        with zeeguu.app.app_context():
+            for session_id, last_use in use_dates.items():
+                cls.query.filter(cls.id == session_id).update({cls.last_use: last_use}, synchronize_session=False)
+            db.session.commit()
+
+    @classmethod
+    def _write_use_dates_periodically(cls):
+        while True:
+            time.sleep(cls.USE_DATES_WRITE_INTERVAL)
+            try:
+                cls.write_use_dates()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
 
 class Language(db.Model):
     __table_args__ = {'mysql_collate': 'utf8_bin'}
@@ -397,8 +558,10 @@ class RankedWord(db.Model, util.JSONSerializable):
     rank = db.Column(db.Integer)
     db.UniqueConstraint(word, language_id)
 
-    ranked_words_cache = {}
-
+    # language id -> util.RankTable of the ranked words of the language,
+    # loaded on first use
+    rank_tables = None
+    rank_tables_lock = threading.Lock()
 
     def __init__(self, word, language, rank):
         self.word = word
@@ -432,6 +595,38 @@ class RankedWord(db.Model, util.JSONSerializable):
         except sqlalchemy.orm.exc.NoResultFound:
             return False
 
+    # Words looked up per query by find_many and exists_many
+    LOOKUP_BATCH_SIZE = 1000
+
+    @classmethod
+    def find_many(cls, words, language):
+        """
+        :return: dict mapping the lowercase forms of the words
+            which are ranked in the language to their RankedWord
+        """
+        lowercase_words = list(set(word.lower() for word in words))
+        ranked_words = {}
+        for i in xrange(0, len(lowercase_words), cls.LOOKUP_BATCH_SIZE):
+            batch = lowercase_words[i:i + cls.LOOKUP_BATCH_SIZE]
+            for ranked_word in cls.query.filter(cls.language == language).filter(cls.word.in_(batch)):
+                ranked_words[ranked_word.word] = ranked_word
+        return ranked_words
+
+    @classmethod
+    def exists_many(cls, words, language):
+        """
+        :return: set of those of the words which are ranked in the language
+        """
+        words = set(words)
+        lowercase_words = list(set(word.lower() for word in words))
+        ranked = set()
+        for i in xrange(0, len(lowercase_words), cls.LOOKUP_BATCH_SIZE):
+            batch = lowercase_words[i:i + cls.LOOKUP_BATCH_SIZE]
+            ranked.update(word for (word,) in db.session.query(cls.word)
+                                                        .filter(cls.language == language)
+                                                        .filter(cls.word.in_(batch)))
+        return set(word for word in words if word.lower() in ranked)
+
     @classmethod
     def words_list(cls):
         words_list = []
@@ -439,22 +634,84 @@ class RankedWord(db.Model, util.JSONSerializable):
              words_list.append(word.word)
         return words_list
 
+    @classmethod
+    def build_rank_table(cls, language_id):
+        return util.RankTable.build(db.session.query(cls.word, cls.rank, cls.id).filter(cls.language_id == language_id))
+
     @classmethod
     def cache_ranked_words(cls):
-        cls.ranked_words_cache = {}
+        rank_tables = {}
         for language in Language.all():
-            ranked_words = cls.find_all(language)
-            for ranked_word in ranked_words:
-                ranked_word_key = language.id + '_' + ranked_word.word
-                cls.ranked_words_cache[ranked_word_key] = ranked_word
+            rank_tables[language.id] = cls.build_rank_table(language.id)
+        cls.rank_tables = rank_tables
 
     @classmethod
-    def find_cache(cls, word, language):
-        try:
-            ranked_word_key = language.id + '_' + word.lower()
-            return cls.ranked_words_cache[ranked_word_key]
-        except KeyError:
-            return None
+    def fingerprints(cls):
+        """
+        :return: dict mapping the language ids to the (row count, largest id)
+            of their ranked words, as in the fingerprint of a util.RankTable
+        """
+        return dict((language_id, (count, max_id)) for (language_id, count, max_id) in
+                    db.session.query(cls.language_id, sqlalchemy.func.count(cls.id), sqlalchemy.func.max(cls.id))
+                              .group_by(cls.language_id))
+
+    @classmethod
+    def rank_table_path(cls, directory, language_id):
+        return os.path.join(directory, language_id + ".rank")
+
+    @classmethod
+    def save_rank_tables(cls, directory):
+        """
+        Writes the rank tables of all the languages to files in the directory,
+        from which load_rank_tables can memory map them.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for language in Language.all():
+            cls.build_rank_table(language.id).save(cls.rank_table_path(directory, language.id))
+
+    @classmethod
+    def load_rank_tables(cls, directory):
+        """
+        Memory maps the rank table files written by save_rank_tables,
+        so that all the processes of the server share one copy of them.
+
+        A file which does not match the ranked words in the database, because
+        they changed since the file was written, is not used: the rank table
+        of its language is built from the database instead.
+        """
+        fingerprints = cls.fingerprints()
+        rank_tables = {}
+        for language in Language.all():
+            fingerprint = fingerprints.get(language.id, (0, 0))
+            path = cls.rank_table_path(directory, language.id)
+            try:
+                rank_table = util.RankTable.open(path)
+            except (IOError, ValueError):
+                rank_table = None
+            if rank_table is None or rank_table.fingerprint != fingerprint:
+                print "Rank table " + path + " is missing or out of date, run build_rank_tables.py"
+                rank_table = cls.build_rank_table(language.id)
+            rank_tables[language.id] = rank_table
+        cls.rank_tables = rank_tables
+
+    @classmethod
+    def rank_table(cls, language):
+        """
+        :return: util.RankTable of the (lowercase) ranked words of the language
+        """
+        if cls.rank_tables is None:
+            with cls.rank_tables_lock:
+                if cls.rank_tables is None:
+                    directory = zeeguu.app.config.get("RANK_TABLE_DIRECTORY")
+                    if directory:
+                        cls.load_rank_tables(directory)
+                    else:
+                        cls.cache_ranked_words()
+        rank_table = cls.rank_tables.get(language.id)
+        if rank_table is None:
+            return util.RankTable.empty()
+        return rank_table
 
 
 class UserWord(db.Model, util.JSONSerializable):
@@ -476,7 +733,8 @@ class UserWord(db.Model, util.JSONSerializable):
     def __init__(self, word, language, rank = None):
         self.word = word
         self.language = language
-        self.rank = rank
+        if rank is not None:
+            self.rank = rank
 
     def __repr__(self):
         return '<UserWord %r>' % (self.word)
@@ -506,9 +764,32 @@ class UserWord(db.Model, util.JSONSerializable):
                              .filter(cls.language == language)
                              .one())
         except sqlalchemy.orm.exc.NoResultFound:
-            rank = UserWord.find_rank(word.lower(),language)
-            return cls(word, language,rank)
+            return cls.create_with_rank(word, language)
 
+    @classmethod
+    def find_many(cls, words, language):
+        """
+        :return: dict mapping each of the words to its UserWord. The words
+            which are not in the database yet get a new UserWord, which is
+            not added to the session.
+        """
+        words = list(set(words))
+        user_words = {}
+        for i in xrange(0, len(words), RankedWord.LOOKUP_BATCH_SIZE):
+            batch = words[i:i + RankedWord.LOOKUP_BATCH_SIZE]
+            for user_word in cls.query.filter(cls.language == language).filter(cls.word.in_(batch)):
+                user_words[user_word.word] = user_word
+        for word in words:
+            if word not in user_words:
+                user_words[word] = cls.create_with_rank(word, language)
+        return user_words
+
+    @classmethod
+    def create_with_rank(cls, word, language):
+        # The rank is resolved through the rank table instead of a query
+        user_word = cls(word, language)
+        user_word.rank_id = RankedWord.rank_table(language).id_of(word.lower())
+        return user_word
 
     @classmethod
     def find_rank(cls, word, language):
@@ -587,52 +868,62 @@ class ExerciseBasedProbability(db.Model):
     def find_all(cls):
         return cls.query.all()
 
-    def wrong_formula(self, count_wrong_after_another):
-        if self.DEFAULT_MIN_PROBABILITY * count_wrong_after_another >= float(self.probability):
-           self.probability = decimal.Decimal('0.1')
-        else:
-            self.probability=(float(self.probability) - self.DEFAULT_MIN_PROBABILITY * count_wrong_after_another)
+    @classmethod
+    def wrong_formula(cls, probability, count_wrong_after_another):
+        if cls.DEFAULT_MIN_PROBABILITY * count_wrong_after_another >= float(probability):
+            return decimal.Decimal('0.1')
+        return float(probability) - cls.DEFAULT_MIN_PROBABILITY * count_wrong_after_another
 
-    def correct_formula(self, count_correct_after_another):
-        if  float(self.probability) +  self.DEFAULT_MIN_PROBABILITY * count_correct_after_another >= 1.0 :
-           self.probability = decimal.Decimal('1.0')
-        else:
-             self.probability=(float(self.probability) + self.DEFAULT_MIN_PROBABILITY * count_correct_after_another)
+    @classmethod
+    def correct_formula(cls, probability, count_correct_after_another):
+        if float(probability) + cls.DEFAULT_MIN_PROBABILITY * count_correct_after_another >= 1.0:
+            return decimal.Decimal('1.0')
+        return float(probability) + cls.DEFAULT_MIN_PROBABILITY * count_correct_after_another
 
-    def update_probability_after_adding_bookmark_with_same_word(self, bookmark, user):
-        count_bookmarks_with_same_word = len(Bookmark.find_all_by_user_and_word(user, bookmark.origin))
+    def update_probability_after_adding_bookmark_with_same_word(self, count_bookmarks_with_same_word):
         self.probability = (float(self.probability * count_bookmarks_with_same_word) + 0.1)/(count_bookmarks_with_same_word+1)# compute avg probability of all bookmarks with same word
 
+    @classmethod
+    def fold_exercise_outcome(cls, probability, count_correct_after_another, count_wrong_after_another, outcome):
+        """
+        Updates the probability of knowing a bookmark after one more exercise.
+
+        :return: the new (probability, count_correct_after_another,
+            count_wrong_after_another)
+        """
+        if outcome == ExerciseOutcome.TOO_EASY:
+            probability = decimal.Decimal('1.0')
+            count_wrong_after_another = 0
+        elif outcome == ExerciseOutcome.SHOW_SOLUTION:
+            probability //= 2
+            if float(probability) < 0.1:
+                probability = decimal.Decimal('0.1')
+            count_correct_after_another = 0
+        elif outcome == ExerciseOutcome.CORRECT:
+            count_correct_after_another += 1
+            count_wrong_after_another = 0
+            if float(probability) < 1.0:
+                probability = cls.correct_formula(probability, count_correct_after_another)
+            else:
+                probability = decimal.Decimal('1.0')
+        elif outcome == ExerciseOutcome.WRONG:
+            count_wrong_after_another += 1
+            count_correct_after_another = 0
+            if float(probability) > 0.1:
+                probability = cls.wrong_formula(probability, count_wrong_after_another)
+            else:
+                probability = decimal.Decimal('0.1')
+        return probability, count_correct_after_another, count_wrong_after_another
 
-
-
-
-    #calculates the probability of knowing a certain bookmark after a exercise_outcome.
+    #calculates the probability of knowing a certain bookmark by replaying its whole exercise log.
     def calculate_known_bookmark_probability(self,bookmark):
         count_correct_after_another = 0
         count_wrong_after_another = 0
         sorted_exercise_log_after_date=sorted(bookmark.exercise_log, key=lambda x: x.time, reverse=False)
         for exercise in sorted_exercise_log_after_date:
-            if exercise.outcome.outcome == ExerciseOutcome.TOO_EASY:
-                self.probability = decimal.Decimal('1.0')
-                count_wrong_after_another =0
-            elif exercise.outcome.outcome == ExerciseOutcome.SHOW_SOLUTION:
-                self.probability //=2
-                if float(self.probability) < 0.1:
-                    self.probability = decimal.Decimal('0.1')
-                count_correct_after_another =0
-            elif exercise.outcome.outcome == ExerciseOutcome.CORRECT:
-                count_correct_after_another +=1
-                count_wrong_after_another = 0
-                if float(self.probability) < 1.0:
-                    self.correct_formula(count_correct_after_another)
-                else: self.probability = decimal.Decimal('1.0')
-            elif exercise.outcome.outcome == ExerciseOutcome.WRONG:
-                 count_wrong_after_another += 1
-                 count_correct_after_another = 0
-                 if float(self.probability) > 0.1:
-                    self.wrong_formula(count_wrong_after_another)
-                 else: self.probability = decimal.Decimal('0.1')
+            self.probability, count_correct_after_another, count_wrong_after_another = \
+                self.fold_exercise_outcome(self.probability, count_correct_after_another,
+                                           count_wrong_after_another, exercise.outcome.outcome)
 
     def halfProbability(self):
         self.probability /=2
@@ -719,7 +1010,8 @@ class EncounterBasedProbability(db.Model):
 #         This function controls if prob is already 1.0, else it adds 0.1. It maximum adds 0.1, therefore cannot exceed 1
     def boost_prob(self):
         if float(self.probability) <> 1.0:
-            self.probability = float(self.probability) + 0.1
+            # Decimals, so that boosting several times before a flush gives the same result as after each flush
+            self.probability = decimal.Decimal(str(self.probability)) + decimal.Decimal('0.1')
 
 
 
@@ -739,6 +1031,13 @@ class KnownWordProbability(db.Model):
     probability = db.Column(db.DECIMAL(10,9), nullable = False)
     db.CheckConstraint('probability>=0', 'probability<=1')
 
+    # Snapshots of the known probabilities of each user (user id -> (version, snapshot)).
+    # The version of a user is increased whenever one of their probabilities gets committed.
+    # Probabilities written by other processes are picked up once a snapshot is too old.
+    SNAPSHOT_MAX_AGE = 60
+    known_probabilities_cache = util.LRUCache(1000, time_to_live=SNAPSHOT_MAX_AGE)
+    known_probabilities_versions = {}
+
     def __init__(self, user, user_word, ranked_word,probability):
         self.user = user
         self.user_word = user_word
@@ -768,14 +1067,27 @@ class KnownWordProbability(db.Model):
 
     @classmethod
     def find_all_by_user_cached(cls, user):
-        known_probabilities_cache = {}
-        known_probabilities = cls.find_all_by_user(user)
-        for known_probability in known_probabilities:
-            user_word = known_probability.user_word
-            # TODO: Why are there many KnownWordProbabilities with no user word in the database?
-            if user_word is not None:
-                known_probabilities_cache[user_word.word] = known_probability.probability
-        return known_probabilities_cache
+        """
+        :return: dict mapping the words of the user to the probability that the user knows them.
+            The dict is a snapshot shared between requests; it must not be modified.
+        """
+        version = cls.known_probabilities_versions.get(user.id, 0)
+        cached = cls.known_probabilities_cache.get(user.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        # TODO: Why are there many KnownWordProbabilities with no user word in the database?
+        snapshot = dict(db.session.query(UserWord.word, cls.probability)
+                                  .filter(cls.user_word_id == UserWord.id)
+                                  .filter(cls.user_id == user.id)
+                                  .all())
+        cls.known_probabilities_cache.put(user.id, (version, snapshot))
+        return snapshot
+
+    @classmethod
+    def invalidate_cache(cls, user_id):
+        cls.known_probabilities_versions[user_id] = cls.known_probabilities_versions.get(user_id, 0) + 1
+        cls.known_probabilities_cache.pop(user_id, None)
 
     @classmethod
     def find_all_by_user_with_rank(cls, user):
@@ -865,7 +1177,17 @@ class Bookmark(db.Model):
 
     exercise_log = relationship("Exercise", secondary="bookmark_exercise_mapping")
 
+    # Running state of the exercise log, so that a new exercise
+    # can be taken into account without replaying the whole log
+    exercise_probability = db.Column(db.DECIMAL(10,9), nullable=False, default=0.1)
+    correct_streak = db.Column(db.Integer, nullable=False, default=0)
+    wrong_streak = db.Column(db.Integer, nullable=False, default=0)
+    # Whether the latest decisive outcome (too easy, show solution or wrong) was too easy
+    latest_outcome_too_easy = db.Column(db.Boolean, nullable=False, default=False)
 
+    # (user id, language id) -> (version, frozenset of the words the user is learning)
+    learning_words_cache = util.LRUCache(10000, time_to_live=60)
+    learning_words_versions = {}
 
 
     def __init__(self, origin, translation, user, text, time):
@@ -874,9 +1196,71 @@ class Bookmark(db.Model):
         self.user = user
         self.time = time
         self.text = text
+        self.exercise_probability = ExerciseBasedProbability.DEFAULT_MIN_PROBABILITY
+        self.correct_streak = 0
+        self.wrong_streak = 0
+        self.latest_outcome_too_easy = False
 
     def add_new_exercise(self, exercise):
         self.exercise_log.append(exercise)
+        if exercise.outcome.outcome == ExerciseOutcome.TOO_EASY:
+            self.latest_outcome_too_easy = True
+        elif exercise.outcome.outcome in (ExerciseOutcome.SHOW_SOLUTION, ExerciseOutcome.WRONG):
+            self.latest_outcome_too_easy = False
+        self.exercise_probability, self.correct_streak, self.wrong_streak = \
+            ExerciseBasedProbability.fold_exercise_outcome(self.exercise_probability, self.correct_streak,
+                                                           self.wrong_streak, exercise.outcome.outcome)
+
+    def replay_exercise_log(self):
+        """
+        Recomputes the exercise state of the bookmark from its whole log.
+        :return: (exercise_probability, correct_streak, wrong_streak)
+        """
+        state = (decimal.Decimal('0.1'), 0, 0)
+        for exercise in sorted(self.exercise_log, key=lambda x: x.time):
+            state = ExerciseBasedProbability.fold_exercise_outcome(*(state + (exercise.outcome.outcome,)))
+        return state
+
+    def exercise_state_is_consistent(self):
+        probability, correct_streak, wrong_streak = self.replay_exercise_log()
+        return abs(float(probability) - float(self.exercise_probability)) < 1e-6 \
+            and correct_streak == self.correct_streak \
+            and wrong_streak == self.wrong_streak \
+            and self.latest_outcome_too_easy == self.check_is_latest_outcome_too_easy()
+
+    @classmethod
+    def find_learning_words_cached(cls, user, language):
+        """
+        :return: frozenset of the words in the language which the user is
+            currently learning. It is shared between requests.
+        """
+        version = cls.learning_words_versions.get(user.id, 0)
+        cached = cls.learning_words_cache.get((user.id, language.id))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        words = frozenset(word for (word,) in
+                          cls.find_by_user_and_state(user, False, language).with_entities(UserWord.word))
+        cls.learning_words_cache.put((user.id, language.id), (version, words))
+        return words
+
+    @classmethod
+    def invalidate_learning_words_cache(cls, user_id):
+        cls.learning_words_versions[user_id] = cls.learning_words_versions.get(user_id, 0) + 1
+
+    @classmethod
+    def find_by_user_and_state(cls, user, too_easy, language=None):
+        """
+        :param too_easy: whether the latest decisive outcome of the
+            bookmarks must have been too easy
+        :param language: only bookmarks of words in this language
+        :return: query for the bookmarks of the user, newest first
+        """
+        query = cls.query.filter(cls.user_id == user.id)\
+            .filter(cls.latest_outcome_too_easy == too_easy)
+        if language is not None:
+            query = query.join(UserWord, cls.origin).filter(UserWord.language_id == language.id)
+        return query.order_by(cls.time.desc())
 
     def translation(self):
         return self.translations_list[0]
@@ -909,69 +1293,113 @@ class Bookmark(db.Model):
         db.session.add(exercise)
 
     def split_words_from_context(self):
-        words_of_bookmark_content = []
-        bookmark_content_words = re.findall(r'(?u)\w+', self.text.content)
-        words_of_bookmark_content.extend(bookmark_content_words)
-        return words_of_bookmark_content
+        return util.split_word_tokens(self.text.content, self.text.content_hash)
 
 
 
     def context_words_with_rank(self):
         ranked_context_words = self.split_words_from_context()
         while self.origin.word in ranked_context_words: ranked_context_words.remove(self.origin.word)
-        filtered_words_known_from_user = []
-        for word_known in ranked_context_words:
-            if RankedWord.exists(word_known.lower(), self.origin.language):
-                filtered_words_known_from_user.append(word_known)
-        return filtered_words_known_from_user
-
-    def calculate_known_word_probability_after_adding_exercise_based_probability(self, ex_prob, enc_prob, user):
-        if KnownWordProbability.exists(user, self.origin,self.origin.rank) and enc_prob == None: #checks if only exercise based probability exists
-            known_word_prob = KnownWordProbability.find(user, self.origin,self.origin.rank)
-            known_word_prob.probability = ex_prob.probability
-        elif enc_prob is not None: #checks if encounter based probability also exists
-            known_word_prob = KnownWordProbability.find(user, self.origin, self.origin.rank)
-            known_word_prob.probability = KnownWordProbability.calculateKnownWordProb(ex_prob,enc_prob)
-        else:
-            known_word_prob = KnownWordProbability.find(user, self.origin,self.origin.rank, ex_prob.probability) # new known word probability created as it did not exist.
-
-        return known_word_prob
+        ranked = RankedWord.exists_many(ranked_context_words, self.origin.language)
+        return [word for word in ranked_context_words if word in ranked]
+
+    def calculate_probabilities_after_adding_a_bookmark(self, user, language, commit=True):
+        """
+        Updates the probabilities that the user knows the words of the context
+        and the bookmarked word.
+
+        The rows involved are loaded with one query per table, the updates are
+        computed in memory and written with a single commit (or left in the
+        session when commit is False).
+        """
+        # Gives ids to the bookmark and its words, in case they are new
+        zeeguu.db.session.flush()
+        origin = self.origin
+
+        context_words = [word for word in self.split_words_from_context() if word != origin.word]
+        lowercase_words = set(word.lower() for word in context_words)
+        lowercase_words.add(origin.word.lower())
+        ranked_words = RankedWord.find_many(lowercase_words, language)
+        context_words = [word for word in context_words if word.lower() in ranked_words]
+        ranked_word_ids = [ranked_word.id for ranked_word in ranked_words.values()]
+
+        user_words = {}
+        if context_words:
+            user_words = dict((user_word.word, user_word) for user_word in
+                              UserWord.query.filter(UserWord.language == language)
+                                            .filter(UserWord.word.in_(list(set(context_words)))).all())
+        user_word_ids = [user_word.id for user_word in user_words.values()] + [origin.id]
+
+        encounter_probs = {}
+        if ranked_word_ids:
+            encounter_probs = dict((prob.ranked_word_id, prob) for prob in
+                                   EncounterBasedProbability.query
+                                   .filter(EncounterBasedProbability.user_id == user.id)
+                                   .filter(EncounterBasedProbability.ranked_word_id.in_(ranked_word_ids)).all())
+        exercise_probs = dict((prob.user_word_id, prob) for prob in
+                              ExerciseBasedProbability.query
+                              .filter(ExerciseBasedProbability.user_id == user.id)
+                              .filter(ExerciseBasedProbability.user_word_id.in_(user_word_ids)).all())
+        known_word_probs_filter = KnownWordProbability.user_word_id == origin.id
+        if ranked_word_ids:
+            known_word_probs_filter = sqlalchemy.or_(known_word_probs_filter,
+                                                     KnownWordProbability.ranked_word_id.in_(ranked_word_ids))
+        known_word_probs = dict(((prob.user_word_id, prob.ranked_word_id), prob) for prob in
+                                KnownWordProbability.query
+                                .filter(KnownWordProbability.user_id == user.id)
+                                .filter(known_word_probs_filter).all())
+        count_bookmarks_with_same_word = Bookmark.query.filter_by(user=user, origin=origin).count()
+
+        def update_known_word_prob(user_word, ranked_word, probability):
+            key = (user_word.id if user_word else None, ranked_word.id if ranked_word else None)
+            known_word_prob = known_word_probs.get(key)
+            if known_word_prob is None:
+                known_word_prob = KnownWordProbability(user, user_word, ranked_word, probability)
+                zeeguu.db.session.add(known_word_prob)
+                known_word_probs[key] = known_word_prob
+            else:
+                known_word_prob.probability = probability
 
-    def calculate_probabilities_after_adding_a_bookmark(self, user,language):
         # computations for adding encounter based probability
-        for word in self.context_words_with_rank():
-            enc_prob = EncounterBasedProbability.find_or_create(word,user)
-            zeeguu.db.session.add(enc_prob)
-            zeeguu.db.session.commit()
-            user_word = None
-            ranked_word = enc_prob.ranked_word
-            if UserWord.exists(word,language):
-                user_word = UserWord.find(word,language)
-                if ExerciseBasedProbability.exists(user,user_word): #checks if exercise based probability exists for words in context
-                    ex_prob = ExerciseBasedProbability.find(user,user_word)
-                    known_word_prob_1 = KnownWordProbability.find(user,user_word,ranked_word)
-                    known_word_prob_1.probability = known_word_prob_1.calculateKnownWordProb(ex_prob, enc_prob) #updates known word probability as exercise based probability already existed.
+        for word in context_words:
+            ranked_word = ranked_words[word.lower()]
+            enc_prob = encounter_probs.get(ranked_word.id)
+            if enc_prob is None:
+                enc_prob = EncounterBasedProbability(user, ranked_word, 1, EncounterBasedProbability.DEFAULT_PROBABILITY)
+                zeeguu.db.session.add(enc_prob)
+                encounter_probs[ranked_word.id] = enc_prob
+            else:
+                enc_prob.not_looked_up_counter += 1
+                enc_prob.boost_prob()
+
+            user_word = user_words.get(word)
+            if user_word is not None:
+                ex_prob = exercise_probs.get(user_word.id)
+                if ex_prob is not None: # known word probability combines exercise and encounter based probability
+                    update_known_word_prob(user_word, ranked_word,
+                                           KnownWordProbability.calculateKnownWordProb(ex_prob.probability, enc_prob.probability))
             else:
-                if KnownWordProbability.exists(user, user_word,ranked_word):
-                    known_word_prob_1 = KnownWordProbability.find(user,user_word,ranked_word)
-                    known_word_prob_1.probability = enc_prob.probability # updates known word probability as encounter based probability already existed
-                else:
-                    known_word_prob_1 = KnownWordProbability.find(user,user_word,ranked_word, enc_prob.probability) # new known word probability created as it did not exist
-                    zeeguu.db.session.add(known_word_prob_1)
+                update_known_word_prob(None, ranked_word, enc_prob.probability)
 
         # computations for adding exercise based probability
-        enc_prob = None
-        ex_prob = ExerciseBasedProbability.find(user, self.origin)
-        if RankedWord.exists(self.origin.word, language): #checks if ranked_word exists for that looked up word
-            ranked_word = RankedWord.find(self.origin.word, language)
-            if EncounterBasedProbability.exists(user, ranked_word): # checks if encounter based probability exists for that looked up word
-                enc_prob = EncounterBasedProbability.find(user, ranked_word)
+        ranked_word = ranked_words.get(origin.word.lower())
+        if ranked_word is not None: # only for looked up words that have a rank
+            enc_prob = encounter_probs.get(ranked_word.id)
+            if enc_prob is not None:
                 enc_prob.reset_prob() # reset encounter based probability to 0.5
-            if ExerciseBasedProbability.exists(user, self.origin):
-                ex_prob.update_probability_after_adding_bookmark_with_same_word(self,user)
-            zeeguu.db.session.add(ex_prob)
-            known_word_prob_2 = self.calculate_known_word_probability_after_adding_exercise_based_probability(ex_prob,enc_prob, user)
-            zeeguu.db.session.add(known_word_prob_2)
+            ex_prob = exercise_probs.get(origin.id)
+            if ex_prob is None:
+                ex_prob = ExerciseBasedProbability(user, origin, ExerciseBasedProbability.DEFAULT_MIN_PROBABILITY)
+                zeeguu.db.session.add(ex_prob)
+            else:
+                ex_prob.update_probability_after_adding_bookmark_with_same_word(count_bookmarks_with_same_word)
+            if enc_prob is not None:
+                update_known_word_prob(origin, origin.rank,
+                                       KnownWordProbability.calculateKnownWordProb(ex_prob.probability, enc_prob.probability))
+            else:
+                update_known_word_prob(origin, origin.rank, ex_prob.probability)
+
+        if commit:
             zeeguu.db.session.commit()
 
     @classmethod
@@ -990,6 +1418,26 @@ class Bookmark(db.Model):
             id= b_id
         ).first()
 
+    @classmethod
+    def find_translation(cls, word, from_lang_code, to_lang_code):
+        """
+        :return: the translation users chose most often when bookmarking the word,
+            or None if nobody bookmarked it yet
+        """
+        translation = (db.session.query(WordAlias.word)
+                       .join(bookmark_translation_mapping, bookmark_translation_mapping.c.translation_id == WordAlias.id)
+                       .join(cls, cls.id == bookmark_translation_mapping.c.bookmark_id)
+                       .join(UserWord, cls.origin_id == UserWord.id)
+                       .filter(UserWord.word == word)
+                       .filter(UserWord.language_id == from_lang_code)
+                       .filter(WordAlias.language_id == to_lang_code)
+                       .group_by(WordAlias.word)
+                       .order_by(sqlalchemy.func.count().desc())
+                       .first())
+        if translation is None:
+            return None
+        return translation[0]
+
     @classmethod
     def find_all_by_user_and_word(cls, user, word):
         return cls.query.filter_by(
@@ -1009,6 +1457,7 @@ class Bookmark(db.Model):
     #             return True
     #     return False
 
+    # replays the exercise log; latest_outcome_too_easy holds the same value
     def check_is_latest_outcome_too_easy(self):
         sorted_exercise_log_by_latest=sorted(self.exercise_log, key=lambda x: x.time, reverse=True)
         for exercise in sorted_exercise_log_by_latest:
@@ -1118,8 +1567,10 @@ class Text(db.Model):
         return '<Text %r>' % (self.language.short)
 
     def words(self):
-        for word in re.split(re.compile(u"[^\\w]+", re.U), self.content):
-            yield UserWord.find(word, self.language)
+        words = util.split_word_tokens(self.content, self.content_hash)
+        user_words = UserWord.find_many(words, self.language)
+        for word in words:
+            yield user_words[word]
 
 
     def shorten_word_context(self, given_word, max_word_count):
@@ -1193,3 +1644,74 @@ class Search(db.Model):
     def __repr__(self):
         return '<Search %r>' % (self.user_word.word)
 
+
+
+class ProbabilityUpdate(db.Model):
+    """
+    A bookmark whose probabilities still have to be recalculated
+    by the update_probabilities worker.
+    """
+    __tablename__ = 'probability_update'
+    __table_args__ = {'mysql_collate': 'utf8_bin'}
+
+    id = db.Column(db.Integer, primary_key=True)
+    bookmark_id = db.Column(db.Integer, db.ForeignKey("bookmark.id", ondelete="CASCADE"), nullable=False)
+    bookmark = db.relationship("Bookmark")
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user = db.relationship("User")
+    time = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, bookmark):
+        self.bookmark = bookmark
+        self.user = bookmark.user
+        self.time = datetime.datetime.now()
+        self.attempts = 0
+
+    @classmethod
+    def find_all(cls):
+        return cls.query.order_by(cls.id).all()
+
+    @classmethod
+    def find_pending(cls, max_attempts):
+        """
+        :return: the updates which failed less than max_attempts times, oldest first
+        """
+        return cls.query.filter(cls.attempts < max_attempts).order_by(cls.id).all()
+
+
+
+def _invalidate_cache_on_commit(model_class, key_of, invalidate):
+    """
+    Calls invalidate(key) after each commit that inserted, updated or deleted
+    instances of the model class, once for every key_of(instance).
+    """
+    changed = 'changed_' + model_class.__name__
+
+    def remember(mapper, connection, instance):
+        session = sqlalchemy.orm.object_session(instance)
+        if session is not None:
+            session.info.setdefault(changed, set()).add(key_of(instance))
+
+    def remember_if_modified(mapper, connection, instance):
+        # Instances are also "updated" when only one of their collections changed
+        session = sqlalchemy.orm.object_session(instance)
+        if session is not None and session.is_modified(instance, include_collections=False):
+            remember(mapper, connection, instance)
+
+    def invalidate_changed(session):
+        for key in session.info.pop(changed, ()):
+            invalidate(key)
+
+    def forget_changed(session):
+        session.info.pop(changed, None)
+
+    sqlalchemy.event.listen(model_class, 'after_insert', remember)
+    sqlalchemy.event.listen(model_class, 'after_update', remember_if_modified)
+    sqlalchemy.event.listen(model_class, 'after_delete', remember)
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', invalidate_changed)
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback', forget_changed)
+
+
+_invalidate_cache_on_commit(KnownWordProbability, lambda p: p.user_id, KnownWordProbability.invalidate_cache)
+_invalidate_cache_on_commit(Bookmark, lambda b: b.user_id, Bookmark.invalidate_learning_words_cache)
@@ -0,0 +1,117 @@
+# -*- coding: utf8 -*-
+
+"""
+translation.py
+Translation of words for the /translate endpoint.
+
+Translations are looked up, in this order, in a cache in memory,
+in the translations of existing bookmarks, and finally with the
+translator, which by default is the Google Translate API.
+
+Concurrent requests for the same translation are coalesced, so a
+burst of users translating the same word makes one upstream call.
+"""
+import json
+import threading
+import urllib2
+
+import zeeguu
+from zeeguu import util
+from zeeguu.model import Bookmark
+
+
+class GoogleTranslator(object):
+    TRANSLATE_URL = "https://www.googleapis.com/language/translate/v2"
+    TIMEOUT = 10
+
+    def translate(self, word, from_lang_code, to_lang_code):
+        api_key = zeeguu.app.config.get("TRANSLATE_API_KEY")
+
+        # Note, that there is quote and quote_plus. The Google API prefers quote_plus,
+        # This seems to be the convention for info submitted from forms via GET.
+        url = self.TRANSLATE_URL + \
+            "?q=" + word + \
+            "&target=" + to_lang_code.encode('utf8') + \
+            "&format=text".encode('utf8') + \
+            "&source=" + from_lang_code.encode('utf8') + \
+            "&key=" + api_key
+        result = json.loads(urllib2.urlopen(url, timeout=self.TIMEOUT).read())
+        return result['data']['translations'][0]['translatedText']
+
+
+class StubTranslator(object):
+    """
+    Translator that does not leave the machine, for tests and benchmarks.
+    Words without a given translation are translated to themselves.
+    """
+    def __init__(self, translations=None):
+        self.translations = translations or {}
+        self.calls = 0
+
+    def translate(self, word, from_lang_code, to_lang_code):
+        self.calls += 1
+        return self.translations.get(word, word)
+
+
+class _PendingTranslation(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.translation = None
+        self.error = None
+
+
+class CachingTranslator(object):
+    def __init__(self, translator, max_size=10000):
+        self.translator = translator
+        self.cache = util.LRUCache(max_size)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def translate(self, word, from_lang_code, to_lang_code):
+        key = (word, from_lang_code, to_lang_code)
+        translation = self.cache.get(key)
+        if translation is not None:
+            return translation
+
+        with self.lock:
+            pending = self.pending.get(key)
+            first = pending is None
+            if first:
+                pending = self.pending[key] = _PendingTranslation()
+
+        if not first:
+            # Somebody else is already translating this word
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.translation
+
+        try:
+            translation = Bookmark.find_translation(word.replace("+", " "), from_lang_code, to_lang_code)
+            if translation is None:
+                translation = self.translator.translate(word, from_lang_code, to_lang_code)
+            self.cache.put(key, translation)
+            pending.translation = translation
+            return translation
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.done.set()
+
+
+translator = CachingTranslator(GoogleTranslator())
+
+
+def use_translator(new_translator):
+    """
+    Replaces the translator behind the cache, e.g. with a StubTranslator.
+    """
+    global translator
+    translator = CachingTranslator(new_translator)
+
+
+def translate(word, from_lang_code, to_lang_code):
+    return translator.translate(word, from_lang_code, to_lang_code)
@@ -5,6 +5,7 @@ import os.path
 import flask
 
 import zeeguu
+from zeeguu import util
 import zeeguu.gym.views
 import zeeguu.api.endpoints
 import zeeguu.account.views
@@ -36,6 +37,10 @@ app.config.from_pyfile("config.cfg", silent=True) #config.cfg is in the instance
 
 instance = flask.Blueprint("instance", __name__, static_folder=instance_path(app))
 
+util.PageExtractor.cache = util.ArticleCache(os.path.join(app.instance_path, "articles"),
+                                             app.config.get("ARTICLE_CACHE_SIZE"),
+                                             app.config.get("ARTICLE_CACHE_MAX_AGE"))
+
 app.register_blueprint(instance)
 app.register_blueprint(zeeguu.gym.views.gym)
 app.register_blueprint(zeeguu.api.endpoints.api)
@@ -0,0 +1,25 @@
+# -*- coding: utf8 -*-
+import sys
+
+import zeeguu
+from zeeguu.model import RankedWord
+
+
+def build_rank_tables(directory):
+    zeeguu.app.test_request_context().push()
+    zeeguu.db.session.commit()
+    RankedWord.save_rank_tables(directory)
+    print 'Rank tables written to ' + directory
+
+
+if __name__ == "__main__":
+    # Run after changing the ranked words (e.g. with add_ranked_words.py),
+    # then restart the server so that it maps the new files
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    else:
+        directory = zeeguu.app.config.get("RANK_TABLE_DIRECTORY")
+    if not directory:
+        print "Usage: build_rank_tables <directory>, or set RANK_TABLE_DIRECTORY"
+        sys.exit(1)
+    build_rank_tables(directory)
@@ -0,0 +1,16 @@
+# -*- coding: utf8 -*-
+import zeeguu
+
+
+def create_db():
+    """
+    Creates the tables which do not exist yet. Existing tables are not changed,
+    for those see the scripts in sql_script.
+    """
+    with zeeguu.app.app_context():
+        zeeguu.db.create_all()
+    print 'Tables created'
+
+
+if __name__ == "__main__":
+    create_db()
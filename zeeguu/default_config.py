@@ -4,3 +4,24 @@ HOST = "127.0.0.1"
 PORT = 9000
 DEBUG = True
 SECRET_KEY = 'debuggingkey'
+
+# Extracted articles, kept in the instance folder
+ARTICLE_CACHE_SIZE = 200 * 1024 * 1024 # bytes
+ARTICLE_CACHE_MAX_AGE = 3600 # seconds
+
+# Leave the probability updates after bookmarking to the update_probabilities worker
+ASYNC_PROBABILITY_UPDATES = False
+
+# Directory with the rank table files written by build_rank_tables.py.
+# If not set, every process builds the rank tables from the database.
+RANK_TABLE_DIRECTORY = None
+
+# Score the difficulty of large batches of texts in this many processes.
+# Batches with at least PARALLEL_SCORING_MIN_TEXTS texts or
+# PARALLEL_SCORING_MIN_SIZE characters are scored in parallel. Needs the
+# rank table files of RANK_TABLE_DIRECTORY. Batches that the processes do
+# not score within PARALLEL_SCORING_TIMEOUT seconds are scored in the request.
+PARALLEL_SCORING_PROCESSES = 0
+PARALLEL_SCORING_MIN_TEXTS = 200
+PARALLEL_SCORING_MIN_SIZE = 1024 * 1024
+PARALLEL_SCORING_TIMEOUT = 10
@@ -363,8 +363,7 @@ def create_new_exercise(exercise_outcome,exercise_source,exercise_solving_speed,
     ex_prob = model.ExerciseBasedProbability.find(flask.g.user, bookmark.origin)
     total_prob = 0
     for b in bookmarks:
-        ex_prob.calculate_known_bookmark_probability(b)
-        total_prob +=float(ex_prob.probability)
+        total_prob +=float(b.exercise_probability)
     ex_prob.probability = total_prob/len(bookmarks)
     model.db.session.commit()
     if model.RankedWord.exists(bookmark.origin.word,bookmark.origin.language):
@@ -0,0 +1,32 @@
+# -*- coding: utf8 -*-
+import sys
+import zeeguu
+from zeeguu.model import Bookmark
+
+
+def check_bookmark_state(fix=False):
+    """
+    Replays the exercise log of every bookmark and compares the result
+    with the exercise state stored on the bookmark.
+
+    :param fix: overwrite the stored state of inconsistent bookmarks
+    :return: the inconsistent bookmarks
+    """
+    zeeguu.app.test_request_context().push()
+    zeeguu.db.session.commit()
+    inconsistent = []
+    for bookmark in Bookmark.find_all():
+        if not bookmark.exercise_state_is_consistent():
+            inconsistent.append(bookmark)
+            if fix:
+                bookmark.exercise_probability, bookmark.correct_streak, bookmark.wrong_streak = \
+                    bookmark.replay_exercise_log()
+                bookmark.latest_outcome_too_easy = bookmark.check_is_latest_outcome_too_easy()
+    zeeguu.db.session.commit()
+    print str(len(inconsistent)) + ' inconsistent bookmarks' + (' fixed' if fix else '')
+    return inconsistent
+
+
+if __name__ == "__main__":
+    # with --check only reports, otherwise backfills the state
+    check_bookmark_state(fix='--check' not in sys.argv)
@@ -65,13 +65,15 @@ def set_know_word_prob():
             known_word_probability_obj = KnownWordProbability.find(user,None, prob.ranked_word,prob.probability)
         zeeguu.db.session.add(known_word_probability_obj)
         zeeguu.db.session.commit()
+    ranked_words = {}
+    for language in Language.all():
+        words = [prob.user_word.word for prob in ex_probs if prob.user_word.language == language]
+        ranked_words[language.id] = RankedWord.find_many(words, language)
     for prob in ex_probs:
         user = prob.user
         language = prob.user_word.language
         word = prob.user_word.word
-        ranked_word = None
-        if RankedWord.exists(word,language):
-            ranked_word = RankedWord.find(word,language)
+        ranked_word = ranked_words[language.id].get(word.lower())
         if not EncounterBasedProbability.exists(user,ranked_word):
             if UserWord.exists(word, language):
                 user_word = UserWord.find(word, language)
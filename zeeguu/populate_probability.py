@@ -2,6 +2,7 @@
 # -*- coding: utf8 -*-
 import re
 import zeeguu
+from zeeguu import util
 from zeeguu.model import RankedWord, Language,Bookmark,User,ExerciseBasedProbability, EncounterBasedProbability
 from re import compile as _Re
 
@@ -30,13 +31,14 @@ def set_default_encounter_based_prob():
             for bookmark in Bookmark.find_by_specific_user(user):
                 if bookmark.origin.language == lang:
                     # bookmark_content_words = re.sub("[^\w]", " ",  bookmark.text.content).split()
-                    bookmark_content_words = re.findall(r'(?u)\w+', bookmark.text.content)
+                    bookmark_content_words = util.split_word_tokens(bookmark.text.content, bookmark.text.content_hash)
                     words_of_all_bookmarks_content.extend(bookmark_content_words)
                     marked_words_of_user_in_text.append(bookmark.origin.word)
             words_known_from_user= [word for word in words_of_all_bookmarks_content if word not in marked_words_of_user_in_text]
+            ranked_words = RankedWord.find_many(words_known_from_user, lang)
             for word_known in words_known_from_user:
-                if RankedWord.exists(word_known, lang):
-                   rank = RankedWord.find(word_known, lang)
+                if word_known.lower() in ranked_words:
+                   rank = ranked_words[word_known.lower()]
                    if EncounterBasedProbability.exists(user, rank):
                        prob = EncounterBasedProbability.find(user,rank, default_probability)
                        prob.not_looked_up_counter +=1
@@ -11,6 +11,9 @@ from zeeguu import util
 import json
 import re
 import time
+import os
+import tempfile
+import shutil
 
 
 sondernExampleData = dict(
@@ -313,6 +316,19 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
         assert learned_bookmarks_count+1== len(learned_bookmarks)
         assert any(bookmark['id'] == latest_bookmark_id for bookmark in learned_bookmarks)
 
+    def test_get_learned_bookmarks_of_one_language_page_by_page(self):
+        formData = dict(
+            url='http://mir.lu',
+            context='un peu de chance')
+        rv = self.api_post('/bookmark_with_context/fr/chance/en/luck', formData)
+        french_bookmark_id = json.loads(rv.data)
+        rv = self.api_get('/get_learned_bookmarks/de')
+        learned_bookmarks = json.loads(rv.data)
+        assert not any(bookmark['id'] == french_bookmark_id for bookmark in learned_bookmarks)
+
+        rv = self.app.get(self.in_session('/get_learned_bookmarks/de', ['offset=1', 'limit=2']))
+        assert json.loads(rv.data) == learned_bookmarks[1:3]
+
     def test_get_not_looked_up_words(self):
         rv = self.api_get('/bookmarks_by_day/with_context')
         bookmarks_by_day = []
@@ -341,6 +357,109 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
         assert any (bookmark['word'] == 'an' for bookmark in estimated_user_voc_after)
         assert not any (bookmark['word'] == 'auch' for bookmark in estimated_user_voc_after)
 
+    def test_asynchronous_probability_updates(self):
+        import zeeguu.update_probabilities
+        rv = self.api_get('/get_not_looked_up_words/de')
+        estimated_user_voc_before = json.loads(rv.data)
+
+        zeeguu.app.config["ASYNC_PROBABILITY_UPDATES"] = True
+        try:
+            formData = dict(
+                url='http://mir.lu',
+                context='es an auch')
+            self.api_post('/bookmark_with_context/de/auch/en/also', formData)
+        finally:
+            zeeguu.app.config["ASYNC_PROBABILITY_UPDATES"] = False
+
+        rv = self.api_get('/get_not_looked_up_words/de')
+        assert len(json.loads(rv.data)) == len(estimated_user_voc_before)
+
+        zeeguu.update_probabilities.process_pending_updates(coalesce_delay=0)
+        assert zeeguu.model.ProbabilityUpdate.find_all() == []
+        rv = self.api_get('/get_not_looked_up_words/de')
+        estimated_user_voc_after = json.loads(rv.data)
+        assert len(estimated_user_voc_after) == len(estimated_user_voc_before)+2
+        assert any (bookmark['word'] == 'es' for bookmark in estimated_user_voc_after)
+
+
+    def test_probability_updates_added_between_polls(self):
+        import zeeguu.update_probabilities
+        # The worker starts with an empty queue
+        zeeguu.update_probabilities.process_pending_updates(coalesce_delay=0)
+
+        # Meanwhile the web server queues an update, through its own connection
+        web_session = zeeguu.db.create_scoped_session()
+        try:
+            bookmark = web_session.query(zeeguu.model.Bookmark).first()
+            web_session.add(zeeguu.model.ProbabilityUpdate(bookmark))
+            web_session.commit()
+
+            zeeguu.update_probabilities.process_pending_updates(coalesce_delay=0)
+            assert web_session.query(zeeguu.model.ProbabilityUpdate).count() == 0
+        finally:
+            web_session.remove()
+
+    def test_failing_probability_update(self):
+        import zeeguu.update_probabilities
+        Bookmark = zeeguu.model.Bookmark
+        failing, valid = Bookmark.query.limit(2).all()
+        failing_id = failing.id
+        zeeguu.db.session.add(zeeguu.model.ProbabilityUpdate(failing))
+        zeeguu.db.session.add(zeeguu.model.ProbabilityUpdate(valid))
+        zeeguu.db.session.commit()
+
+        calculate = Bookmark.calculate_probabilities_after_adding_a_bookmark
+        def calculate_or_fail(bookmark, *args, **kwargs):
+            if bookmark.id == failing_id:
+                raise ValueError("failing update")
+            return calculate(bookmark, *args, **kwargs)
+        Bookmark.calculate_probabilities_after_adding_a_bookmark = calculate_or_fail
+        try:
+            for i in range(zeeguu.update_probabilities.MAX_ATTEMPTS + 1):
+                zeeguu.update_probabilities.process_pending_updates(coalesce_delay=0)
+        finally:
+            Bookmark.calculate_probabilities_after_adding_a_bookmark = calculate
+
+        # The valid update went through, the failing one is given up
+        updates = zeeguu.model.ProbabilityUpdate.find_all()
+        assert [update.bookmark_id for update in updates] == [failing_id]
+        assert updates[0].attempts == zeeguu.update_probabilities.MAX_ATTEMPTS
+        assert zeeguu.model.ProbabilityUpdate.find_pending(zeeguu.update_probabilities.MAX_ATTEMPTS) == []
+
+    def test_get_vocabulary_statistics(self):
+        formData = dict(
+            url='http://mir.lu',
+            context='es an auch')
+        self.api_post('/bookmark_with_context/de/auch/en/also', formData)
+        rv = self.api_get('/get_vocabulary_statistics')
+        statistics = json.loads(rv.data)
+        user = User.find("i@mir.lu")
+        assert statistics['lower_bounds']['3000'] == user.get_lower_bound_percentage_of_basic_vocabulary()
+        assert statistics['upper_bounds']['3000'] == user.get_upper_bound_percentage_of_basic_vocabulary()
+        assert statistics['lower_bounds']['10000'] == user.get_lower_bound_percentage_of_extended_vocabulary()
+        assert statistics['upper_bounds']['10000'] == user.get_upper_bound_percentage_of_extended_vocabulary()
+        assert statistics['probably_known_bookmarked_words'] == user.get_percentage_of_probably_known_bookmarked_words()
+        assert statistics['upper_bounds']['3000'] > 0
+
+        rv = self.app.get(self.in_session('/get_vocabulary_statistics', ['rank_thresholds=100']))
+        statistics = json.loads(rv.data)
+        assert statistics['upper_bounds'].keys() == ['100']
+
+    def test_get_not_encountered_words(self):
+        rv = self.api_get('/get_not_encountered_words/de')
+        not_encountered_words = json.loads(rv.data)
+        assert len(not_encountered_words) == User.find("i@mir.lu").get_not_encountered_words_count()
+
+        rv = self.app.get(self.in_session('/get_not_encountered_words/de', ['offset=1', 'limit=2']))
+        assert json.loads(rv.data) == not_encountered_words[1:3]
+
+        first_word = not_encountered_words[0]['word']
+        formData = dict(
+            url='http://mir.lu',
+            context=first_word + ' auch')
+        self.api_post('/bookmark_with_context/de/auch/en/also', formData)
+        rv = self.api_get('/get_not_encountered_words/de')
+        assert not any(word['word'] == first_word for word in json.loads(rv.data))
 
     def test_set_language(self):
         rv = self.api_post('/learned_language/it')
@@ -367,6 +486,28 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
         assert rv.data > 1
 
 
+    def test_validate_session(self):
+        # the second request is served from the sessions cache
+        assert self.api_get('/validate').data == "OK"
+        assert self.api_get('/validate').data == "OK"
+        rv = self.app.get('/validate?session=-1')
+        assert rv.status_code == 401
+
+    def test_set_language_with_cached_session(self):
+        self.api_get('/learned_language')
+        self.api_post('/learned_language/it')
+        rv = self.api_get('/learned_language')
+        assert rv.data == "it"
+
+    def test_language_changed_by_another_process(self):
+        self.api_get('/learned_language')
+        # An update that does not go through the models of this process
+        zeeguu.db.session.execute("UPDATE user SET learned_language_id = 'it' WHERE email = 'i@mir.lu'")
+        zeeguu.db.session.commit()
+        rv = self.api_get('/learned_language')
+        assert rv.data == "it"
+
+
     def test_get_language(self):
         rv = self.api_get('/learned_language')
         print rv.data
@@ -391,6 +532,31 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
         assert not "context" in some_contrib
 
 
+    def test_get_bookmarks_by_day_page_by_page(self):
+        rv = self.api_get('/bookmarks_by_day/with_context')
+        all_days = json.loads(rv.data)
+        assert len(all_days) > 1
+
+        rv = self.app.get(self.in_session('/bookmarks_by_day/with_context', ['limit=1']))
+        first_page = json.loads(rv.data)
+        assert first_page == all_days[:1]
+
+        rv = self.app.get(self.in_session('/bookmarks_by_day/with_context',
+                                          ['limit=1', 'before=' + first_page[-1]['iso_date']]))
+        assert json.loads(rv.data) == all_days[1:2]
+
+    def test_streamed_responses_match_the_regular_ones(self):
+        formData = dict(
+            url='http://mir.lu',
+            context='gute nacht sondern')
+        self.api_post('/bookmark_with_context/de/sondern/en/but', formData)
+        self.api_post('/gym/create_new_exercise/Too easy/Recognize/10000/1')
+        for url in ['/user_words', '/get_not_encountered_words/de',
+                    '/get_probably_known_words/de', '/bookmarks_by_day/with_context']:
+            rv = self.api_get(url)
+            streamed_rv = self.app.get(self.in_session(url, ['stream=true']))
+            assert json.loads(streamed_rv.data) == json.loads(rv.data)
+
     def test_password_hash(self):
         p1 = "test"
         p2 = "pass"
@@ -440,6 +606,99 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
             elif learnability['id'] is 4:
                 assert learnability['score'] == 0.0
 
+    def test_text_learnability_follows_exercises(self):
+        data = json.dumps(dict(
+            texts=[dict(content='Der die das besteht warum, wer nicht fragt bleibt jeweils sogar dumm!', id=3)]))
+
+        rv = self.api_post('/get_learnability_for_text/de', data, 'application/json')
+        assert json.loads(rv.data)['learnabilities'][0]['count'] == 3
+
+        rv = self.api_get('/bookmarks_by_day/with_context')
+        sogar_bookmark_id = [bookmark['id'] for day in json.loads(rv.data)
+                             for bookmark in day['bookmarks'] if bookmark['from'] == 'sogar'][0]
+        self.api_post('/gym/create_new_exercise/Too easy/Recognize/10000/' + str(sogar_bookmark_id))
+
+        rv = self.api_post('/get_learnability_for_text/de', data, 'application/json')
+        assert json.loads(rv.data)['learnabilities'][0]['count'] == 2
+
+
+    def test_approximate_text_difficulty(self):
+        texts = [dict(content='Der die das besteht warum, wer nicht fragt bleibt jeweils sogar dumm!', id=1),
+                 dict(content='Dies ist ein Test.', id=2)]
+        rv = self.api_post('/get_difficulty_for_text/de', json.dumps(dict(texts=texts)), 'application/json')
+        difficulties = json.loads(rv.data)['difficulties']
+
+        data = json.dumps(dict(texts=texts, approximate_median='true', histogram_bins=10))
+        rv = self.api_post('/get_difficulty_for_text/de', data, 'application/json')
+        approximations = json.loads(rv.data)['difficulties']
+        for difficulty, approximation in zip(difficulties, approximations):
+            assert abs(approximation['score_median'] - difficulty['score_median']) < 0.001
+            assert approximation['score_average'] == difficulty['score_average']
+        assert sum(approximations[1]['histogram']) == 4
+
+        data = json.dumps(dict(texts=texts, histogram_bins=10 ** 9))
+        rv = self.api_post('/get_difficulty_for_text/de', data, 'application/json')
+        assert rv.data == 'FAIL'
+
+    def test_parallel_text_difficulty(self):
+        texts = [dict(content='Der die das besteht warum, wer nicht fragt bleibt jeweils sogar dumm!', id=i)
+                 if i % 2 else dict(content='Dies ist ein Test.', id=i) for i in range(20)]
+        data = json.dumps(dict(texts=texts))
+
+        rv = self.api_post('/get_difficulty_for_text/de', data, 'application/json')
+        difficulties = json.loads(rv.data)['difficulties']
+        assert [difficulty['id'] for difficulty in difficulties] == range(20)
+
+        de = zeeguu.model.Language.find("de")
+        directory = tempfile.mkdtemp()
+        RankedWord.save_rank_tables(directory)
+        RankedWord.load_rank_tables(directory)
+        zeeguu.app.config["RANK_TABLE_DIRECTORY"] = directory
+        zeeguu.app.config["PARALLEL_SCORING_PROCESSES"] = 2
+        zeeguu.app.config["PARALLEL_SCORING_MIN_TEXTS"] = 10
+        zeeguu.api.endpoints.start_scoring_pool()
+        pool = zeeguu.api.endpoints.scoring_pool
+        try:
+            rank_table = RankedWord.rank_table(de)
+            path = RankedWord.rank_table_path(directory, de.id)
+            assert pool.text_difficulties(texts, path, rank_table.fingerprint, {}, 10) == \
+                util.text_difficulties(texts, rank_table, {})
+            # Workers with another version of the file leave the texts to the request
+            assert pool.text_difficulties(texts, path, (0, 0), {}, 10) is None
+
+            rv = self.api_post('/get_difficulty_for_text/de', data, 'application/json')
+            assert json.loads(rv.data)['difficulties'] == difficulties
+        finally:
+            zeeguu.api.endpoints.scoring_pool = None
+            pool.close()
+            zeeguu.app.config["RANK_TABLE_DIRECTORY"] = None
+            zeeguu.app.config["PARALLEL_SCORING_PROCESSES"] = 0
+            zeeguu.app.config["PARALLEL_SCORING_MIN_TEXTS"] = 200
+            RankedWord.cache_ranked_words()
+            shutil.rmtree(directory)
+
+    def test_text_scores(self):
+        texts = [dict(content='Der die das besteht warum, wer nicht fragt bleibt jeweils sogar dumm!', id=3),
+                 dict(content='Dies ist ein weiterer Test!', id=4)]
+
+        rv = self.api_post('/get_difficulty_for_text/de', json.dumps(dict(texts=texts)), 'application/json')
+        difficulties = json.loads(rv.data)['difficulties']
+        rv = self.api_post('/get_learnability_for_text/de', json.dumps(dict(texts=texts)), 'application/json')
+        learnabilities = json.loads(rv.data)['learnabilities']
+
+        rv = self.api_post('/get_scores_for_text/de', json.dumps(dict(texts=texts, histogram_bins=4)),
+                           'application/json')
+        scores = json.loads(rv.data)
+        assert scores['learnabilities'] == learnabilities
+        for difficulty, scored_difficulty in zip(difficulties, scores['difficulties']):
+            histogram = scored_difficulty.pop('histogram')
+            assert len(histogram) == 4
+            assert scored_difficulty == difficulty
+        assert sum(scores['difficulties'][0]['histogram']) == 12
+
+        rv = self.api_post('/get_scores_for_text/de', json.dumps(dict(texts=texts, histogram_bins=10 ** 9)),
+                           'application/json')
+        assert rv.data == 'FAIL'
 
     def test_content_from_url(self):
         # parameters
@@ -459,6 +718,76 @@ class API_Tests(zeeguu_testcase.ZeeguuTestCase):
                 print url['content']
                 print url['image']
 
+    def test_busy_host_does_not_block_other_hosts(self):
+        finished = {}
+        start = time.time()
+
+        def extract(url):
+            if 'slow.example.com' in url:
+                time.sleep(0.2)
+            finished[url] = time.time() - start
+            return dict(content='content', image='')
+
+        original_extract = util.PageExtractor.__dict__['extract']
+        util.PageExtractor.extract = staticmethod(extract)
+        try:
+            urls = [dict(url='http://slow.example.com/%d' % i, id=i) for i in range(40)]
+            urls.append(dict(url='http://other.example.com/', id=40))
+            contents = util.PageExtractor.extract_all(urls, 10)
+        finally:
+            util.PageExtractor.extract = original_extract
+
+        assert len(contents) == 41
+        # The url of the other host does not wait for the slow one
+        assert finished['http://other.example.com/'] < 0.2
+        # Nor does the slow host get more than its share of the pool
+        assert max(finished.values()) >= 40 / util.PageExtractor.MAX_WORKERS_PER_HOST * 0.2
+
+    def test_article_cache_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            first = util.ArticleCache(directory, 1000, 3600)
+            second = util.ArticleCache(directory, 1000, 3600)
+
+            first.put('http://mir.lu/1', 'x' * 300, '')
+            assert second.get('http://mir.lu/1')['content'] == 'x' * 300
+
+            # Both processes keep the directory within its size
+            second.put('http://mir.lu/2', 'y' * 300, '')
+            first.put('http://mir.lu/3', 'z' * 300, '')
+            second.put('http://mir.lu/4', 'w' * 300, '')
+            assert first.stats()['size'] <= 1000
+            assert second.get('http://mir.lu/4') is not None
+            assert first.get('http://mir.lu/1') is None
+        finally:
+            shutil.rmtree(directory)
+
+    def test_article_cache_usage_estimate(self):
+        directory = tempfile.mkdtemp()
+        try:
+            first = util.ArticleCache(directory, 10000, 3600)
+            second = util.ArticleCache(directory, 10000, 3600)
+
+            first.put('http://mir.lu/1', 'x' * 300, '')
+            second.put('http://mir.lu/2', 'y' * 300, '')
+            # Replacing an article does not count it twice
+            second.put('http://mir.lu/1', 'z' * 100, '')
+
+            sizes = [os.path.getsize(os.path.join(directory, name))
+                     for name in os.listdir(directory) if name.endswith('.json')]
+            for cache in [first, second]:
+                stats = cache.stats()
+                assert stats['articles'] == 2
+                assert stats['size'] == sum(sizes)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_article_cache_stats(self):
+        rv = self.app.get('/article_cache_stats')
+        stats = json.loads(rv.data)
+        for key in ["articles", "size", "max_size", "hits", "misses", "revalidations"]:
+            assert key in stats
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,10 +8,13 @@ import zeeguu_testcase
 
 from zeeguu_testcase import ZeeguuTestCase
 import unittest
-from zeeguu import model, db
+from zeeguu import model, db, util
 from zeeguu.model import UserWord, Language, User
 import datetime
+import decimal
 import random
+import sqlalchemy.event
+import sqlalchemy.orm
 
 
 class Dbtest(ZeeguuTestCase):
@@ -103,6 +106,146 @@ class Dbtest(ZeeguuTestCase):
 
 
 
+    def test_known_probabilities_snapshot_is_invalidated(self):
+        word = UserWord.find("baumhaus", self.de)
+        assert "baumhaus" not in model.KnownWordProbability.find_all_by_user_cached(self.mir)
+
+        db.session.add(model.KnownWordProbability(self.mir, word, None, 0.5))
+        db.session.commit()
+
+        assert "baumhaus" in model.KnownWordProbability.find_all_by_user_cached(self.mir)
+
+
+    def test_probabilities_after_adding_a_bookmark(self):
+        es = UserWord.find("es", self.de)
+        db.session.add(model.ExerciseBasedProbability(self.mir, es, 0.6))
+        # The probabilities follow the language of the bookmark, not the one the user learns now
+        self.mir.learned_language = Language.find("fr")
+        db.session.commit()
+
+        url = model.Url.find("http://mir.lu/probabilities", "Probabilities")
+        text = model.Text("auch es auch", self.de, url)
+        bookmark = model.Bookmark(UserWord.find("baumhaus", self.de), UserWord.find("tree house", Language.find("en")),
+                                  self.mir, text, datetime.datetime.now())
+        db.session.add(bookmark)
+
+        commits = []
+        def count_commit(session):
+            commits.append(session)
+        sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit', count_commit)
+        try:
+            bookmark.calculate_probabilities_after_adding_a_bookmark(self.mir, self.de)
+        finally:
+            sqlalchemy.event.remove(sqlalchemy.orm.Session, 'after_commit', count_commit)
+        assert len(commits) == 1
+
+        auch = model.RankedWord.find("auch", self.de)
+        ranked_es = model.RankedWord.find("es", self.de)
+        encounters = dict((prob.ranked_word_id, prob) for prob in model.EncounterBasedProbability.find_all_by_user(self.mir))
+        # auch is encountered twice: created at 0.5, then boosted once
+        assert encounters[auch.id].not_looked_up_counter == 2
+        assert encounters[auch.id].probability == decimal.Decimal('0.6')
+        assert encounters[ranked_es.id].not_looked_up_counter == 1
+        assert encounters[ranked_es.id].probability == decimal.Decimal('0.5')
+
+        known = dict(((prob.user_word_id, prob.ranked_word_id), prob.probability)
+                     for prob in model.KnownWordProbability.find_all_by_user(self.mir))
+        # Created for the word without a user word, from its encounters only
+        assert known[(None, auch.id)] == decimal.Decimal('0.6')
+        # Combines the exercises and the encounters of the word
+        assert known[(es.id, ranked_es.id)] == decimal.Decimal('0.58')
+
+
+    def test_bookmark_exercise_state_matches_log_replay(self):
+        bookmark = model.Bookmark.find_by_specific_user(self.mir)[0]
+        correct = model.ExerciseOutcome.query.filter_by(outcome=model.ExerciseOutcome.CORRECT).one()
+        wrong = model.ExerciseOutcome.query.filter_by(outcome=model.ExerciseOutcome.WRONG).one()
+        recognize = model.ExerciseSource.query.filter_by(source="Recognize").one()
+
+        time = datetime.datetime.now()
+        for i, outcome in enumerate([correct, correct, wrong, correct]):
+            exercise = model.Exercise(outcome, recognize, 1000, time + datetime.timedelta(seconds=i))
+            bookmark.add_new_exercise(exercise)
+            db.session.add(exercise)
+        db.session.commit()
+
+        assert bookmark.correct_streak == 1
+        assert bookmark.wrong_streak == 0
+        assert not bookmark.latest_outcome_too_easy
+        assert bookmark.exercise_state_is_consistent()
+
+        too_easy = model.ExerciseOutcome.query.filter_by(outcome=model.ExerciseOutcome.TOO_EASY).one()
+        exercise = model.Exercise(too_easy, recognize, 1000, time + datetime.timedelta(seconds=10))
+        bookmark.add_new_exercise(exercise)
+        db.session.add(exercise)
+        db.session.commit()
+
+        assert bookmark.latest_outcome_too_easy
+        assert bookmark in model.Bookmark.find_by_user_and_state(self.mir, True, bookmark.origin.language).all()
+        assert bookmark.exercise_state_is_consistent()
+
+
+    def test_ranked_words_bulk_lookup(self):
+        words = ["Auch", "es", "unexistingword"]
+        assert model.RankedWord.exists_many(words, self.de) == set(["Auch", "es"])
+
+        ranked_words = model.RankedWord.find_many(words, self.de)
+        assert sorted(ranked_words.keys()) == ["auch", "es"]
+        assert ranked_words["auch"] == model.RankedWord.find("auch", self.de)
+
+
+    def test_rank_table_matches_ranked_words(self):
+        model.RankedWord.cache_ranked_words()
+        rank_table = model.RankedWord.rank_table(self.de)
+        assert len(rank_table) == len(model.RankedWord.find_all(self.de))
+        for word in ["auch", "es", "sondern"]:
+            ranked_word = model.RankedWord.find(word, self.de)
+            assert rank_table.get(word) == ranked_word.rank
+            assert rank_table.id_of(word) == ranked_word.id
+        assert "unexistingword" not in rank_table
+        assert util.RankTable(rank_table.to_bytes()).get("auch") == rank_table.get("auch")
+
+    def test_rank_tables_are_loaded_from_files(self):
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        try:
+            model.RankedWord.save_rank_tables(directory)
+            model.RankedWord.load_rank_tables(directory)
+            rank_table = model.RankedWord.rank_table(self.de)
+            assert rank_table.get("auch") == model.RankedWord.find("auch", self.de).rank
+        finally:
+            model.RankedWord.cache_ranked_words()
+            shutil.rmtree(directory)
+
+    def test_out_of_date_rank_table_files_are_not_used(self):
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        try:
+            model.RankedWord.save_rank_tables(directory)
+            db.session.add(model.RankedWord("neuwort", self.de, 100000))
+            db.session.commit()
+
+            model.RankedWord.load_rank_tables(directory)
+            rank_table = model.RankedWord.rank_table(self.de)
+            assert rank_table.id_of("neuwort") == model.RankedWord.find("neuwort", self.de).id
+            assert rank_table.fingerprint == model.RankedWord.fingerprints()[self.de.id]
+        finally:
+            model.RankedWord.cache_ranked_words()
+            shutil.rmtree(directory)
+
+
+    def test_user_words_bulk_lookup(self):
+        model.RankedWord.cache_ranked_words()
+        user_words = UserWord.find_many(["sogar", "auch", "unexistingword"], self.de)
+        assert user_words["sogar"] == UserWord.find("sogar", self.de)
+        assert user_words["sogar"].id is not None
+        assert user_words["auch"].rank_id == model.RankedWord.find("auch", self.de).id
+        assert user_words["unexistingword"].id is None
+        assert user_words["unexistingword"].rank_id is None
+
+
     def test_user_daily_bookmarks(self):
 
         date = datetime.datetime(2011,01,01)
@@ -179,6 +322,19 @@ class Dbtest(ZeeguuTestCase):
     def test_frequent_domains(self):
         print self.mir.frequent_domains()
 
+    def test_split_words_from_text(self):
+        assert util.split_words_from_text(u'Der \xdcber-Test, 3mal _so_ \xe7a!') == [u'Der', u'\xdcber', u'Test', u'\xe7a']
+        assert util.split_words_from_text(u'\u0421\u043b\u043e\u0432\u043e \u2116 1') == [u'\u0421\u043b\u043e\u0432\u043e']
+        assert util.split_word_tokens(u'Der \xdcber-Test, 3mal!') == [u'Der', u'\xdcber', u'Test', u'3mal']
+
+    def test_split_words_of_long_texts_are_cached(self):
+        text = u'Dies ist ein sehr langer Text. ' * 10
+        words = util.split_words_from_text(text)
+        words.append(u'anders')
+        hits = util.tokenizer.token_cache.hits
+        assert util.split_words_from_text(text) == [u'Dies', u'ist', u'ein', u'sehr', u'langer', u'Text'] * 10
+        assert util.tokenizer.token_cache.hits == hits + 1
+
 
 
 
@@ -10,10 +10,12 @@ import zeeguu_testcase
 # Always must be imported first
 # it sets the test DB
 
-from zeeguu.model import User, RankedWord
+from zeeguu.model import User, RankedWord, Language, KnownWordProbability, UserWord, Url, Text, Bookmark
+from zeeguu import util
 import zeeguu
 import json
 import time
+import datetime
 
 class Performance_Tests(zeeguu_testcase.ZeeguuTestCase):
 
@@ -80,6 +82,75 @@ class Performance_Tests(zeeguu_testcase.ZeeguuTestCase):
         print "Difficulty: " + str(average_time) + ' seconds'
 
 
+    def test_text_difficulty_engine(self):
+        text = []
+        for i in xrange(10): # 100 texts
+            text.extend(self.texts)
+
+        RankedWord.cache_ranked_words()
+        language = Language.find('de')
+        user = User.find("i@mir.lu")
+        known_probabilities = KnownWordProbability.find_all_by_user_cached(user)
+        rank_boundary = 10000.0
+
+        # The word by word calculation the engine replaces
+        def difficulties_word_by_word():
+            difficulties = []
+            for t in text:
+                words_difficulty = []
+                for word in util.split_words_from_text(t['content']):
+                    rank = RankedWord.rank_table(language).get(word.lower())
+                    word_difficulty = 1.0
+                    if rank is not None:
+                        known_propability = known_probabilities.get(word, None)
+                        if known_propability is not None:
+                            word_difficulty -= float(known_propability)
+                        elif rank <= rank_boundary:
+                            word_difficulty -= (rank_boundary-(rank-1))/rank_boundary
+                    words_difficulty.append(word_difficulty)
+                words_difficulty.sort()
+                difficulty_median = words_difficulty[len(words_difficulty)/2]
+                difficulty_average = sum(words_difficulty) / float(len(words_difficulty))
+                difficulties.append(dict(score_median=difficulty_median, score_average=difficulty_average, id=t['id']))
+            return difficulties
+
+        def difficulties_engine():
+            return util.text_difficulties(text, RankedWord.rank_table(language), known_probabilities,
+                                          True, rank_boundary)
+
+        # The engine with the dict of ranks the rank table replaces
+        rank_dict = dict((word, rank) for (word, rank) in
+                         zeeguu.db.session.query(RankedWord.word, RankedWord.rank)
+                                          .filter(RankedWord.language_id == language.id))
+
+        def difficulties_engine_with_dict():
+            return util.text_difficulties(text, rank_dict, known_probabilities, True, rank_boundary)
+
+        expected = difficulties_word_by_word()
+        actual = difficulties_engine()
+        for e, a in zip(expected, actual):
+            assert e['score_median'] == a['score_median']
+            assert round(e['score_average'], 9) == round(a['score_average'], 9)
+        assert difficulties_engine_with_dict() == actual
+
+        measurements = dict()
+        for name, calculate in [('word by word', difficulties_word_by_word), ('engine', difficulties_engine),
+                                ('engine with dict', difficulties_engine_with_dict)]:
+            start = time.clock()
+            for i in xrange(10):
+                calculate()
+            measurements[name] = (time.clock() - start) / 10
+
+        print "Difficulty (word by word): " + str(measurements['word by word']) + ' seconds'
+        print "Difficulty (engine): " + str(measurements['engine']) + ' seconds'
+        print "Difficulty (engine with dict): " + str(measurements['engine with dict']) + ' seconds'
+        print "Speedup: " + str(measurements['word by word'] / measurements['engine'])
+
+        assert measurements['engine'] < measurements['word by word']
+        # The compact rank table should cost little over the dict of ranks
+        assert measurements['engine'] < 1.5 * measurements['engine with dict']
+
+
     def test_text_learnability(self):
         text = []
         for i in xrange(10): # 100 texts
@@ -104,6 +175,67 @@ class Performance_Tests(zeeguu_testcase.ZeeguuTestCase):
         print "Learnability: " + str(average_time) + ' seconds'
 
 
+    def test_learned_bookmarks_of_a_heavy_user(self):
+        # A synthetic user with 50'000 bookmarks, half of them too easy
+        de = Language.find('de')
+        user = User("benchmark@zeeguu.org", "Benchmark", "pass", de)
+        url = Url("http://benchmark.zeeguu.org", "Benchmark")
+        text = Text("Ein Text zum Messen", de, url)
+        words = [UserWord("benchmarkwort" + str(i), de) for i in xrange(500)]
+        zeeguu.db.session.add_all([user, url, text] + words)
+        zeeguu.db.session.commit()
+
+        start_time = datetime.datetime(2015, 1, 1)
+        zeeguu.db.session.execute(Bookmark.__table__.insert(), [
+            dict(origin_id=words[i % len(words)].id, user_id=user.id, text_id=text.id,
+                 time=start_time + datetime.timedelta(minutes=i),
+                 exercise_probability=0.1, correct_streak=0, wrong_streak=0,
+                 latest_outcome_too_easy=i % 2 == 0)
+            for i in xrange(50000)])
+        zeeguu.db.session.commit()
+
+        try:
+            start = time.clock()
+            learned_bookmarks = user.get_learned_bookmarks(de)
+            all_time = time.clock() - start
+            assert len(learned_bookmarks) == 25000
+
+            start = time.clock()
+            page = user.get_learned_bookmarks(de, 100, 100)
+            page_time = time.clock() - start
+            assert page == learned_bookmarks[100:200]
+
+            print "Learned bookmarks of 50000 (all): " + str(all_time) + ' seconds'
+            print "Learned bookmarks of 50000 (page of 100): " + str(page_time) + ' seconds'
+        finally:
+            zeeguu.db.session.execute(Bookmark.__table__.delete().where(Bookmark.user_id == user.id))
+            zeeguu.db.session.delete(text)
+            zeeguu.db.session.delete(url)
+            for word in words:
+                zeeguu.db.session.delete(word)
+            zeeguu.db.session.delete(user)
+            zeeguu.db.session.commit()
+
+
+    def test_startup_time(self):
+        # Import the package and answer a first request in a fresh interpreter
+        import subprocess
+        import sys
+        script = """
+import time
+start = time.time()
+import zeeguu
+imported = time.time()
+zeeguu.app.test_client().post('/session/i@mir.lu', data=dict(password='pass'))
+print imported - start, time.time() - start
+"""
+        output = subprocess.check_output([sys.executable, "-c", script], env=os.environ)
+        import_time, first_request_time = map(float, output.split()[-2:])
+
+        print "Import: " + str(import_time) + ' seconds'
+        print "Import to first request: " + str(first_request_time) + ' seconds'
+
+
     def test_content_from_url(self):
         data = json.dumps(dict(
             urls=[dict(url='http://www.derbund.ch/wirtschaft/unternehmen-und-konjunktur/die-bankenriesen-in-den-bergkantonen/story/26984250', id=1),
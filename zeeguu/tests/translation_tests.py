@@ -2,9 +2,15 @@ __author__ = 'mircea'
 
 
 import zeeguu_testcase
+from zeeguu.api import translation
 
 class TranslationTests(zeeguu_testcase.ZeeguuTestCase):
 
+    def tearDown(self):
+        # The tests below replace the translator; the later tests get the real one again
+        translation.use_translator(translation.GoogleTranslator())
+        super(TranslationTests, self).tearDown()
+
     def test_get_url_for_dicts_taht_do_nasty_urls(self):
         dictionaries = [
             'http://pda.leo.org/#/search=fantastisch',
@@ -19,6 +25,21 @@ class TranslationTests(zeeguu_testcase.ZeeguuTestCase):
                 print "Fail for " + d
                 print rv.data
 
+    def test_translation_of_bookmarked_word_comes_from_bookmarks(self):
+        stub = translation.StubTranslator()
+        translation.use_translator(stub)
+        rv = self.app.post('/translate/de/en', data=dict(word='sogar'))
+        assert rv.data == 'actually'
+        assert stub.calls == 0
+
+    def test_translations_are_cached(self):
+        stub = translation.StubTranslator(dict(Baumhaus='tree house'))
+        translation.use_translator(stub)
+        for i in range(3):
+            rv = self.app.post('/translate/de/en', data=dict(word='Baumhaus'))
+            assert rv.data == 'tree house'
+        assert stub.calls == 1
+
 
 if __name__ == '__main__':
     unittest.main()
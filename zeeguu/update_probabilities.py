@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+
+"""
+Worker that recalculates the probabilities of the bookmarks added while
+ASYNC_PROBABILITY_UPDATES is enabled. Run it next to the web server:
+
+    python -m zeeguu.update_probabilities
+
+The updates of a user are only processed once the user stopped bookmarking
+for COALESCE_DELAY seconds, and then all together in one transaction. An
+update which fails is retried in the next polls, up to MAX_ATTEMPTS times,
+and then left in the queue for inspection.
+"""
+import time
+import datetime
+import traceback
+
+import zeeguu
+from zeeguu.model import ProbabilityUpdate
+
+
+POLL_INTERVAL = 1 # seconds
+COALESCE_DELAY = 2 # seconds
+MAX_ATTEMPTS = 3
+
+
+def process_pending_updates(coalesce_delay=COALESCE_DELAY):
+    try:
+        # The users in the order of their oldest update
+        users = []
+        updates_by_user = {}
+        for update in ProbabilityUpdate.find_pending(MAX_ATTEMPTS):
+            if update.user not in updates_by_user:
+                users.append(update.user)
+            updates_by_user.setdefault(update.user, []).append(update)
+
+        settled = datetime.datetime.now() - datetime.timedelta(seconds=coalesce_delay)
+        for user in users:
+            updates = updates_by_user[user]
+            if updates[-1].time > settled:
+                continue # the user is still bookmarking
+            update = None
+            try:
+                for update in updates:
+                    bookmark = update.bookmark
+                    bookmark.calculate_probabilities_after_adding_a_bookmark(user, bookmark.origin.language, commit=False)
+                    zeeguu.db.session.delete(update)
+                    # So that an error of the database is raised for its update
+                    zeeguu.db.session.flush()
+                zeeguu.db.session.commit()
+            except Exception:
+                # Only the update which failed counts the attempt, the
+                # others of the user are retried with it in the next poll
+                print "Probability update " + str(update.id) + " failed:"
+                traceback.print_exc()
+                zeeguu.db.session.rollback()
+                update.attempts += 1
+                zeeguu.db.session.commit()
+    finally:
+        # End the transaction even when nothing was committed. Otherwise the
+        # next poll reads the same snapshot and never sees the new updates.
+        zeeguu.db.session.rollback()
+
+
+def run():
+    zeeguu.app.test_request_context().push()
+    while True:
+        try:
+            process_pending_updates()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    run()
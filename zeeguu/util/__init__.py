@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
-from zeeguu.util.encoding import JSONSerializable, encode, encode_error
+from zeeguu.util.encoding import JSONSerializable, encode, encode_error, encode_stream
 from zeeguu.util.hash import text_hash, password_hash
-from zeeguu.util.text import split_words_from_text, generate_histogram, PageExtractor
\ No newline at end of file
+from zeeguu.util.cache import LRUCache
+from zeeguu.util.rank_table import RankTable
+from zeeguu.util.article_cache import ArticleCache
+from zeeguu.util.tokenizer import split_words_from_text, split_word_tokens
+from zeeguu.util.text import PageExtractor
+from zeeguu.util.scoring import split_words_from_texts, text_difficulties, text_learnabilities, ScoringPool
@@ -0,0 +1,207 @@
+# -*- coding: utf8 -*-
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from hashlib import sha1
+
+
+class ArticleCache(object):
+    """
+    Disk-backed cache for extracted articles, keyed by url.
+
+    Every article is stored as a json file in the cache directory, and
+    the directory is the only index: several processes can share it, and
+    each of them sees the articles written by the others. The total size
+    of the files is bounded; when it is exceeded, the least recently used
+    articles are deleted. The modification time of a file records its
+    last use, so the order survives restarts.
+
+    The number and total size of the articles are kept in a small file
+    next to them, which the processes update under a file lock on every
+    put. The directory is only scanned when that estimate exceeds
+    max_size, and then the least recently used articles are deleted down
+    to EVICTION_TARGET of max_size, so that the next puts do not scan it
+    again right away. Every scan corrects the estimate.
+
+    Articles younger than max_age seconds are fresh. Older ones keep the
+    ETag and Last-Modified headers of their page, so that they can be
+    revalidated with a conditional request instead of extracted again.
+    """
+    USAGE_FILE = ".usage"
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, directory, max_size, max_age):
+        self.directory = directory
+        self.usage_path = os.path.join(directory, self.USAGE_FILE)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def file_name(url):
+        if isinstance(url, unicode):
+            url = url.encode("utf8")
+        return sha1(url).hexdigest() + ".json"
+
+    def get(self, url):
+        """
+        :return: the cached article of the url as a dict with 'content',
+            'image', 'etag', 'last_modified' and 'fetched', or None
+        """
+        path = os.path.join(self.directory, self.file_name(url))
+        try:
+            with open(path) as f:
+                article = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if article.get('url') != url:
+            return None
+        return article
+
+    def is_fresh(self, article):
+        return time.time() - article['fetched'] < self.max_age
+
+    def put(self, url, content, image, etag=None, last_modified=None):
+        article = dict(url=url, content=content, image=image, etag=etag,
+                       last_modified=last_modified, fetched=time.time())
+        name = self.file_name(url)
+        path = os.path.join(self.directory, name)
+        try:
+            replaced_size = os.stat(path).st_size
+            added_articles = 0
+        except OSError:
+            replaced_size = 0
+            added_articles = 1
+
+        # Write to a temporary file first, so readers never see half an article
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            json.dump(article, f)
+            size = f.tell()
+        os.rename(temporary_path, path)
+
+        self._add_usage(added_articles, size - replaced_size, keep=name)
+        return article
+
+    def refresh(self, article):
+        """
+        Marks a revalidated article as fresh again.
+        """
+        return self.put(article['url'], article['content'], article['image'],
+                        article['etag'], article['last_modified'])
+
+    def count_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def count_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def count_revalidation(self):
+        with self.lock:
+            self.revalidations += 1
+
+    def stats(self):
+        """
+        The article count and size are the estimate shared by all the
+        processes, the hits, misses and revalidations cover only this process.
+        """
+        usage = None
+        try:
+            with open(self.usage_path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                usage = self._parse_usage(f.read())
+        except IOError:
+            pass
+        if usage is None:
+            usage = self._usage(self._files())
+        articles, size = usage
+        return dict(articles=articles, size=size, max_size=self.max_size,
+                    hits=self.hits, misses=self.misses, revalidations=self.revalidations)
+
+    @staticmethod
+    def _parse_usage(data):
+        try:
+            articles, size = data.split()
+            return int(articles), int(size)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _usage(files):
+        return len(files), sum(size for (mtime, size, name) in files)
+
+    def _add_usage(self, articles, size, keep):
+        """
+        Adds the articles and their size to the shared estimate, and
+        evicts articles, except keep, if it exceeds max_size.
+        """
+        with open(self.usage_path, "a+") as f:
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            usage = self._parse_usage(f.read())
+            if usage is None:
+                # The cache predates the estimate, or it was damaged
+                usage = self._usage(self._files())
+            else:
+                usage = (usage[0] + articles, usage[1] + size)
+            if usage[1] > self.max_size:
+                usage = self._evict(keep)
+            f.seek(0)
+            f.truncate()
+            f.write("%d %d" % usage)
+
+    def _files(self):
+        """
+        :return: list of (last use, size, file name) of the articles in the directory
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    # Deleted by another process in the meantime
+                    continue
+                files.append((info.st_mtime, info.st_size, name))
+        return files
+
+    def _evict(self, keep):
+        """
+        Deletes the least recently used articles, except keep, until the
+        files of all the processes fit in EVICTION_TARGET of max_size.
+
+        :return: the number and total size of the remaining articles
+        """
+        files = sorted(self._files())
+        articles, size = self._usage(files)
+        for mtime, file_size, name in files:
+            if size <= self.max_size * self.EVICTION_TARGET:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                # Already evicted by another process
+                pass
+            articles -= 1
+            size -= file_size
+        return articles, size
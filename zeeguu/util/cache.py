@@ -0,0 +1,59 @@
+# -*- coding: utf8 -*-
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Thread safe dict-like cache that holds at most max_size entries.
+
+    When full, the least recently used entry is evicted. If time_to_live
+    is given (in seconds), entries older than that are treated as missing.
+    Hits and misses are counted for monitoring.
+    """
+    def __init__(self, max_size, time_to_live=None):
+        self.max_size = max_size
+        self.time_to_live = time_to_live
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                stored, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.time_to_live is not None and time.time() - stored > self.time_to_live:
+                self.misses += 1
+                return default
+            self.entries[key] = (stored, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            try:
+                return self.entries.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return dict(size=len(self.entries), max_size=self.max_size, hits=self.hits, misses=self.misses)
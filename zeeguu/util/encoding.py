@@ -21,3 +21,16 @@ def encode(obj):
 
 def encode_error(code, error):
     return make_response(encode(error), code)
+
+
+def encode_stream(items):
+    """
+    Encodes the items as a JSON list, piece by piece.
+    To be used as the body of a streamed response.
+    """
+    yield "["
+    for i, item in enumerate(items):
+        if i > 0:
+            yield ","
+        yield json.dumps(item, default=_encoder)
+    yield "]\n"
@@ -0,0 +1,153 @@
+# -*- coding: utf8 -*-
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy
+
+
+class RankTable(object):
+    """
+    Read only map from the ranked words of a language to their rank and id.
+
+    The whole table lives in a single byte buffer, so it costs a few bytes
+    per word instead of an ORM object, and the buffer can just as well be a
+    memory mapped file shared by several processes. The layout is
+
+        header   "ZRNK", version (uint32), word count n (uint32), word width w (uint32),
+                 row count and largest id of the rows it was built from (uint32)
+        ranks    n int32
+        ids      n int32
+        words    n utf8 encoded words, sorted bytewise, each padded with
+                 zero bytes to w bytes
+
+    all numbers little endian. The parts of the buffer are viewed as numpy
+    arrays without copying them, so that the ranks of all the words of a
+    request are found with one vectorized binary search (get_many).
+
+    The row count and the largest id are the fingerprint of the rows the
+    table was built from, so a table file can be checked against the table
+    of ranked words it should reflect.
+    """
+    MAGIC = "ZRNK"
+    VERSION = 3
+    VERSION_HEADER = struct.Struct("<4sI")
+    HEADER = struct.Struct("<4sIIIII")
+    NUMBERS = numpy.dtype("<i4")
+
+    def __init__(self, data):
+        magic, version = self.VERSION_HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC:
+            raise ValueError("Not a rank table")
+        if version != self.VERSION:
+            raise ValueError("Unsupported rank table version " + str(version))
+        magic, version, count, width, row_count, max_id = self.HEADER.unpack_from(data, 0)
+        self.data = data
+        self.count = count
+        self.width = width
+        self.fingerprint = (row_count, max_id)
+
+        ranks_start = self.HEADER.size
+        ids_start = ranks_start + 4 * count
+        words_start = ids_start + 4 * count
+        self.ranks = numpy.frombuffer(data, self.NUMBERS, count, ranks_start)
+        self.ids = numpy.frombuffer(data, self.NUMBERS, count, ids_start)
+        self.words = numpy.frombuffer(data, "S%d" % width, count, words_start)
+
+    @classmethod
+    def build(cls, ranked_words):
+        """
+        :param ranked_words: iterable of (word, rank, id) tuples
+        :return: the RankTable of the words
+        """
+        entries = {}
+        row_count = 0
+        max_id = 0
+        for word, rank, id in ranked_words:
+            if isinstance(word, unicode):
+                word = word.encode("utf8")
+            entries[word] = (rank, id)
+            row_count += 1
+            max_id = max(max_id, id)
+        words = sorted(entries)
+        width = max([1] + [len(word) for word in words])
+
+        ranks = numpy.array([entries[word][0] or 0 for word in words], dtype=cls.NUMBERS)
+        ids = numpy.array([entries[word][1] for word in words], dtype=cls.NUMBERS)
+        padded_words = numpy.array(words, dtype="S%d" % width)
+
+        return cls(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(words), width, row_count, max_id) +
+                   ranks.tostring() + ids.tostring() + padded_words.tostring())
+
+    @classmethod
+    def empty(cls):
+        return cls.build([])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory maps a rank table file written by save. The pages of the
+        file are shared by all the processes which open it.
+        """
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def save(self, path):
+        # Write to a temporary file first, so that processes opening
+        # the table in the meantime still get the previous version
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(self.to_bytes())
+        os.rename(temporary_path, path)
+
+    def _indices(self, words):
+        """
+        :return: array with the index of each of the words in the table, or -1
+        """
+        encoded = [word.encode("utf8") if isinstance(word, unicode) else word for word in words]
+        if not encoded or not self.count:
+            return numpy.full(len(encoded), -1, dtype=numpy.int64)
+        # Longer words would be cut to the width, and cannot be in the table anyway
+        fits = numpy.array([len(word) <= self.width for word in encoded], dtype=bool)
+        keys = numpy.array(encoded, dtype=self.words.dtype)
+        indices = numpy.minimum(numpy.searchsorted(self.words, keys), self.count - 1)
+        found = fits & (self.words[indices] == keys)
+        return numpy.where(found, indices, -1)
+
+    def get_many(self, words):
+        """
+        :return: int32 array with the rank of each of the words, 0 for the words
+            which are not ranked
+        """
+        indices = self._indices(words)
+        if not self.count:
+            return numpy.zeros(len(indices), dtype=numpy.int32)
+        return numpy.where(indices >= 0, self.ranks[indices], 0).astype(numpy.int32)
+
+    def get(self, word, default=None):
+        """
+        :return: the rank of the word, or default if it is not ranked
+        """
+        i = self._indices([word])[0]
+        if i < 0:
+            return default
+        return int(self.ranks[i])
+
+    def id_of(self, word, default=None):
+        """
+        :return: the id of the RankedWord of the word, or default if it is not ranked
+        """
+        i = self._indices([word])[0]
+        if i < 0:
+            return default
+        return int(self.ids[i])
+
+    def __contains__(self, word):
+        return self._indices([word])[0] >= 0
+
+    def __len__(self):
+        return self.count
+
+    def to_bytes(self):
+        return self.data[:]
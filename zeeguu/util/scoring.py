@@ -0,0 +1,274 @@
+# -*- coding: utf8 -*-
+import multiprocessing
+
+import numpy
+
+from zeeguu.util.rank_table import RankTable
+from zeeguu.util.tokenizer import split_words_from_text
+
+# Resolution of the approximate medians
+MEDIAN_BINS = 1000
+
+# The histograms take len(texts) * histogram_bins counts
+MAX_HISTOGRAM_BINS = 100
+
+
+def split_words_from_texts(texts):
+    """
+    :return: the list of words of every text, so that texts scored in
+        several ways are tokenized only once
+    """
+    return [split_words_from_text(text['content']) for text in texts]
+
+
+def _histograms(difficulty, text_index, text_count, bins, bin_count):
+    """
+    :return: array with a row per text, counting the words of the text
+        in the bins [i / bins, (i + 1) / bins), with the larger difficulties
+        in the last of the bin_count bins
+    """
+    word_bins = numpy.minimum((difficulty * bins).astype(numpy.int64), bin_count - 1)
+    return numpy.bincount(text_index * bin_count + word_bins,
+                          minlength=text_count * bin_count).reshape(text_count, bin_count)
+
+
+def _approximate_medians(difficulty, text_index, lengths):
+    """
+    Finds the median of every text in a histogram of its difficulties,
+    without sorting them. The median is interpolated inside its bin, so it
+    is off by less than 1 / MEDIAN_BINS. Words with a difficulty of exactly
+    1, the unknown words, have a bin of their own, so a median of 1 is exact.
+    """
+    counts = _histograms(difficulty, text_index, len(lengths), MEDIAN_BINS, MEDIAN_BINS + 1)
+    cumulative = counts.cumsum(axis=1)
+    middle = lengths // 2
+    texts = numpy.arange(len(lengths))
+    median_bin = numpy.minimum((cumulative <= middle[:, None]).sum(axis=1), MEDIAN_BINS)
+    bin_counts = numpy.maximum(counts[texts, median_bin], 1)
+    before = cumulative[texts, median_bin] - counts[texts, median_bin]
+    medians = (median_bin + (middle - before + 0.5) / bin_counts) / MEDIAN_BINS
+    medians[median_bin == MEDIAN_BINS] = 1.0
+    return medians
+
+
+def text_difficulties(texts, rank_table, known_probabilities, personalized=True, rank_boundary=10000.0,
+                      words_of_texts=None, histogram_bins=None, approximate_median=False):
+    """
+    Calculates the difficulty of all the given texts in one pass.
+
+    Every text is tokenized once and its words are mapped to their integer
+    frequency rank (0 for words without a rank). The difficulty of the words
+    and the median and average of every text are then computed on arrays
+    instead of word by word. The median is the upper one, the difficulty at
+    index n // 2 of the n sorted difficulties of a text.
+
+    :param texts: list of dicts with the text as 'content' and an 'id'
+    :param rank_table: RankTable (or dict) mapping lowercase words to their rank
+    :param known_probabilities: dict mapping words to the probability that
+        the user knows them
+    :param personalized: use the known probabilities of the user
+    :param rank_boundary: upper boundary for the word frequency rank
+    :param words_of_texts: the words of the texts, if already split
+    :param histogram_bins: also count the words of every text in this many
+        (at most MAX_HISTOGRAM_BINS) equally wide difficulty ranges between 0 and 1
+    :param approximate_median: estimate the medians from a histogram of
+        the difficulties, in linear time, instead of sorting them
+    :return: list of dicts with 'score_median', 'score_average' and 'id'
+        (and 'histogram', the list of counts, if requested), in the same
+        order as the texts
+    """
+    if histogram_bins and histogram_bins > MAX_HISTOGRAM_BINS:
+        raise ValueError("At most %d histogram bins" % MAX_HISTOGRAM_BINS)
+    if not texts:
+        return []
+    if words_of_texts is None:
+        words_of_texts = split_words_from_texts(texts)
+
+    word_codes = []
+    known = []
+    lengths = []
+    codes = {} # index of every distinct lowercase word
+    for words in words_of_texts:
+        for word in words:
+            lowercase_word = word.lower()
+            code = codes.get(lowercase_word)
+            if code is None:
+                code = codes[lowercase_word] = len(codes)
+            word_codes.append(code)
+            known.append(known_probabilities.get(word, numpy.nan) if personalized else numpy.nan)
+        lengths.append(len(words))
+
+    # The distinct words are looked up in the rank table all at once
+    distinct_words = sorted(codes, key=codes.get)
+    if hasattr(rank_table, 'get_many'):
+        distinct_ranks = rank_table.get_many(distinct_words)
+    else:
+        distinct_ranks = numpy.array([rank_table.get(word, 0) for word in distinct_words], dtype=numpy.int32)
+    ranks = distinct_ranks[numpy.array(word_codes, dtype=numpy.int64)].astype(numpy.int32)
+    known = numpy.array(known, dtype=numpy.float64)
+    lengths = numpy.array(lengths, dtype=numpy.int64)
+
+    # Difficulty of each word, between 0 (easy) and 1 (hard)
+    difficulty = numpy.ones(len(ranks), dtype=numpy.float64)
+    ranked = ranks > 0
+    is_known = ranked & ~numpy.isnan(known)
+    difficulty[is_known] -= known[is_known]
+    is_frequent = ranked & ~is_known & (ranks <= rank_boundary)
+    difficulty[is_frequent] -= (rank_boundary - (ranks[is_frequent] - 1)) / rank_boundary
+
+    text_index = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    not_empty = lengths > 0
+
+    # Texts without any words are considered to be hard
+    medians = numpy.ones(len(lengths), dtype=numpy.float64)
+    averages = numpy.ones(len(lengths), dtype=numpy.float64)
+    if not_empty.any():
+        if approximate_median:
+            medians[not_empty] = _approximate_medians(difficulty, text_index, lengths)[not_empty]
+        else:
+            # Sort the words of every text by difficulty, keeping the texts apart
+            sorted_difficulty = difficulty[numpy.lexsort((difficulty, text_index))]
+            medians[not_empty] = sorted_difficulty[starts[not_empty] + lengths[not_empty] // 2]
+        sums = numpy.add.reduceat(difficulty, starts[not_empty])
+        averages[not_empty] = sums / lengths[not_empty]
+
+    histograms = None
+    if histogram_bins:
+        histograms = _histograms(difficulty, text_index, len(lengths), histogram_bins, histogram_bins)
+
+    difficulties = []
+    for i, text in enumerate(texts):
+        text_difficulty = dict(score_median=float(medians[i]), score_average=float(averages[i]), id=text['id'])
+        if histograms is not None:
+            text_difficulty['histogram'] = histograms[i].tolist()
+        difficulties.append(text_difficulty)
+    return difficulties
+
+
+def text_learnabilities(texts, learning_words, words_of_texts=None):
+    """
+    :param texts: list of dicts with the text as 'content' and an 'id'
+    :param learning_words: set of the words the user is currently learning
+    :param words_of_texts: the words of the texts, if already split
+    :return: list of dicts with the 'score' (the fraction of the words of the
+        text which the user is learning), their 'count' and the 'id', in the
+        same order as the texts
+    """
+    if words_of_texts is None:
+        words_of_texts = split_words_from_texts(texts)
+
+    learnabilities = []
+    for text, words in zip(texts, words_of_texts):
+        count = sum(1 for word in words if word in learning_words)
+        score = count / float(len(words)) if words else 0.0
+        learnabilities.append(dict(score=score, count=count, id=text['id']))
+    return learnabilities
+
+
+# The memory mapped rank tables of a ScoringPool worker process, by path
+_worker_rank_tables = None
+
+
+def _init_worker():
+    global _worker_rank_tables
+    _worker_rank_tables = {}
+
+
+def _score_shard(arguments):
+    rank_table_path, fingerprint, texts, words_of_texts, known_probabilities, options = arguments
+    rank_table = _worker_rank_tables.get(rank_table_path)
+    if rank_table is None or rank_table.fingerprint != fingerprint:
+        # Not opened yet, or rebuilt since
+        try:
+            rank_table = _worker_rank_tables[rank_table_path] = RankTable.open(rank_table_path)
+        except (IOError, ValueError):
+            return None
+        if rank_table.fingerprint != fingerprint:
+            return None
+    return text_difficulties(texts, rank_table, known_probabilities, words_of_texts=words_of_texts, **options)
+
+
+class ScoringPool(object):
+    """
+    Persistent pool of processes which compute text difficulties.
+
+    The pool must be started before the server starts any threads, since
+    a process forked from a thread inherits the locks the other threads
+    hold at that moment. It is never stopped while the server runs.
+
+    The workers memory map the same rank table files as the server, so they
+    share their pages. A batch of texts is cut into contiguous shards of
+    about the same size, and the results of the shards are joined back in
+    the order of the texts.
+
+    The texts are split into words before they are sent to the workers, so
+    that every shard only carries the known probabilities of its own words,
+    as floats, instead of all those of the user.
+    """
+    SHARDS_PER_PROCESS = 4
+
+    def __init__(self, processes):
+        """
+        :param processes: the number of worker processes
+        """
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, _init_worker)
+
+    def shards(self, texts):
+        total_size = sum(len(text['content']) for text in texts)
+        shard_size = max(1, total_size // (self.processes * self.SHARDS_PER_PROCESS))
+        shard = []
+        size = 0
+        for text in texts:
+            shard.append(text)
+            size += len(text['content'])
+            if size >= shard_size:
+                yield shard
+                shard = []
+                size = 0
+        if shard:
+            yield shard
+
+    def text_difficulties(self, texts, rank_table_path, fingerprint, known_probabilities, timeout, **options):
+        """
+        Same as text_difficulties, computed in the worker processes.
+
+        :param rank_table_path: the file of the rank table of the language
+        :param fingerprint: the fingerprint the rank table must have
+        :param timeout: maximal time in seconds to wait for the workers
+        :param options: the personalized, rank_boundary, histogram_bins and
+            approximate_median options of text_difficulties
+        :return: the difficulties, or None if the workers did not answer within
+            the timeout or do not have the expected rank table, in which case
+            the texts should be scored by the caller
+        """
+        personalized = options.get('personalized', True)
+        tasks = []
+        for shard in self.shards(texts):
+            words_of_shard = split_words_from_texts(shard)
+            shard_probabilities = {}
+            if personalized:
+                for words in words_of_shard:
+                    for word in words:
+                        if word in known_probabilities and word not in shard_probabilities:
+                            shard_probabilities[word] = float(known_probabilities[word])
+            tasks.append((rank_table_path, fingerprint, [dict(id=text['id']) for text in shard], words_of_shard,
+                          shard_probabilities, options))
+        try:
+            results = self.pool.map_async(_score_shard, tasks).get(timeout)
+        except multiprocessing.TimeoutError:
+            return None
+        difficulties = []
+        for shard_difficulties in results:
+            if shard_difficulties is None:
+                return None
+            difficulties.extend(shard_difficulties)
+        return difficulties
+
+    def close(self):
+        """
+        Stops the workers, once the pool is no longer used.
+        """
+        self.pool.terminate()
+        self.pool.join()
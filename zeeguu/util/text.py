@@ -1,47 +1,31 @@
-import regex
+import collections
+import threading
+import urlparse
+import urllib2
+import Queue
+from multiprocessing.pool import ThreadPool
 from goose import Goose
 
 
-def split_words_from_text(text):
-    words = regex.findall(ur'(\b\p{L}+\b)', text)
-    return words
-
-
-def generate_histogram(words_difficulty):
-    histogram_groups = dict()
-
-    for difficulty in words_difficulty:
-        group = int(difficulty*10)/10.0 # round down
-        # print str(difficulty) + " -> " + str(group)
-        if group in histogram_groups:
-            histogram_groups[group] += 1
-        else:
-            histogram_groups[group] = 1
-
-    current_group = 0.0
-    csv_groups = ""
-    for i in xrange(10):
-        if i is not 9:
-            if current_group in histogram_groups:
-                csv_groups += str(histogram_groups[current_group]) + "; "
-            else:
-                csv_groups += "0; "
-        else:
-            if current_group in histogram_groups:
-                csv_groups += str((histogram_groups[current_group]+histogram_groups[1.0])) + ";"
-            else:
-                csv_groups += str(histogram_groups[1.0]) + ";"
-        current_group += 0.1
-        current_group = round(current_group, 1)
-
-    print csv_groups
-
-
 class PageExtractor:
     goose = Goose()
 
-    def __init__(self, url):
-        self.article = PageExtractor.goose.extract(url=url)
+    # Shared by all requests, created on first use
+    pool = None
+    pool_lock = threading.Lock()
+    # host -> number of its urls in the pool, and its urls waiting for a place
+    host_active = {}
+    host_pending = {}
+    MAX_WORKERS = 20
+    MAX_WORKERS_PER_HOST = 4
+    TIMED_OUT = object()
+
+    # ArticleCache for the extracted articles, set up by the app
+    cache = None
+    FETCH_TIMEOUT = 10
+
+    def __init__(self, url, raw_html=None):
+        self.article = PageExtractor.goose.extract(url=url, raw_html=raw_html)
 
     def get_content(self):
         return self.article.cleaned_text
@@ -53,6 +37,131 @@ class PageExtractor:
             return ""
 
     @classmethod
-    def worker(cls, url, id, result):
-        article = cls(url)
-        result.put(dict(content=article.get_content(), image=article.get_image(), id=id))
\ No newline at end of file
+    def extract(cls, url):
+        """
+        Extracts the article at the url, going through the cache if there is one.
+        Stale articles are revalidated with a conditional request.
+
+        :return: dict with the 'content' and the 'image' of the article
+        """
+        if cls.cache is None:
+            article = cls(url)
+            return dict(content=article.get_content(), image=article.get_image())
+
+        cached = cls.cache.get(url)
+        if cached is not None and cls.cache.is_fresh(cached):
+            cls.cache.count_hit()
+            return cached
+
+        request = urllib2.Request(url, headers={'User-Agent': cls.goose.config.browser_user_agent})
+        if cached is not None:
+            if cached['etag']:
+                request.add_header('If-None-Match', cached['etag'])
+            if cached['last_modified']:
+                request.add_header('If-Modified-Since', cached['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=cls.FETCH_TIMEOUT)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                cls.cache.count_revalidation()
+                return cls.cache.refresh(cached)
+            raise
+
+        cls.cache.count_miss()
+        article = cls(url, response.read())
+        headers = response.info()
+        return cls.cache.put(url, article.get_content(), article.get_image(),
+                             headers.getheader('ETag'), headers.getheader('Last-Modified'))
+
+    @classmethod
+    def get_pool(cls):
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = ThreadPool(cls.MAX_WORKERS)
+            return cls.pool
+
+    @classmethod
+    def submit(cls, task):
+        """
+        Runs the worker task in the pool, or queues it behind the other urls
+        of its host if the host already has MAX_WORKERS_PER_HOST of them in
+        the pool. The urls of a busy host thus never hold pool threads while
+        they wait, and the other hosts do not queue behind them.
+        """
+        pool = cls.get_pool()
+        host = urlparse.urlparse(task[0]).netloc
+        with cls.pool_lock:
+            if cls.host_active.get(host, 0) < cls.MAX_WORKERS_PER_HOST:
+                cls.host_active[host] = cls.host_active.get(host, 0) + 1
+            else:
+                cls.host_pending.setdefault(host, collections.deque()).append(task)
+                return
+        pool.apply_async(cls.run_for_host, (host, task))
+
+    @classmethod
+    def run_for_host(cls, host, task):
+        try:
+            cls.worker(*task)
+        finally:
+            # Hand the place of this url to the next waiting url of the host
+            with cls.pool_lock:
+                pending = cls.host_pending.get(host)
+                if pending:
+                    task = pending.popleft()
+                else:
+                    task = None
+                    cls.host_pending.pop(host, None)
+                    cls.host_active[host] -= 1
+                    if not cls.host_active[host]:
+                        del cls.host_active[host]
+            if task is not None:
+                cls.get_pool().apply_async(cls.run_for_host, (host, task))
+
+    @classmethod
+    def extract_all(cls, urls, timeout):
+        """
+        Extracts the articles of the urls in the shared worker pool.
+
+        Returns as soon as all the urls are done, or when the timeout expires.
+        Urls that were not started by then are skipped.
+
+        :param urls: list of dicts with the 'url' and an 'id'
+        :param timeout: maximal time in seconds to wait for the results
+        :return: list of dicts with the 'content', 'image' and 'id' of the
+            urls that were extracted within the timeout
+        """
+        results = Queue.Queue()
+        cancelled = threading.Event()
+        for url in urls:
+            cls.submit((url['url'], url['id'], results, cancelled))
+
+        # Queue.get with a timeout polls, a blocking get wakes up immediately
+        timer = threading.Timer(timeout, results.put, (cls.TIMED_OUT,))
+        timer.daemon = True
+        timer.start()
+
+        contents = []
+        for i in xrange(len(urls)):
+            content = results.get()
+            if content is cls.TIMED_OUT:
+                break
+            if content is not None:
+                contents.append(content)
+
+        timer.cancel()
+        cancelled.set()
+        return contents
+
+    @classmethod
+    def worker(cls, url, id, result, cancelled=None):
+        """
+        Puts the content of the url in the result queue, or None if it
+        could not be extracted.
+        """
+        if cancelled is not None and cancelled.is_set():
+            return
+        try:
+            article = cls.extract(url)
+            result.put(dict(content=article['content'], image=article['image'], id=id))
+        except Exception:
+            result.put(None)
@@ -0,0 +1,80 @@
+# -*- coding: utf8 -*-
+"""
+Splitting of texts into words.
+
+All the patterns are compiled once. Texts which only contain Latin-1
+characters, which are most of the texts in the languages we support,
+are split with the re module and an explicit character class instead
+of a unicode property lookup per character.
+
+The words of long texts are kept in an LRU cache keyed by the hash of
+the text, the same hash which Text stores as its content_hash, so that
+an article which is scored over and over is split only once.
+"""
+import re
+
+import regex
+
+from zeeguu.util.cache import LRUCache
+from zeeguu.util.hash import text_hash
+
+# A word is a run of letters that is not glued to a digit or an underscore
+LETTER_WORD = regex.compile(ur'\b\p{L}+\b')
+
+# The same for texts with Latin-1 characters only. Besides the letters,
+# only digits and the underscore are word characters in this range
+LATIN1_LETTERS = u'A-Za-z\xaa\xb5\xba\xc0-\xd6\xd8-\xf6\xf8-\xff'
+LATIN1_LETTER_WORD = re.compile(u'(?<![0-9_%(l)s])[%(l)s]+(?![0-9_%(l)s])' % dict(l=LATIN1_LETTERS))
+
+# Runs of letters, digits and underscores
+WORD_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Shorter texts are split faster than they are hashed
+MIN_CACHED_LENGTH = 200
+token_cache = LRUCache(1000)
+
+
+def _is_latin1(text):
+    try:
+        text.encode('latin-1')
+        return True
+    except UnicodeError:
+        return False
+
+
+def _letter_words(text):
+    if isinstance(text, unicode) and _is_latin1(text):
+        return LATIN1_LETTER_WORD.findall(text)
+    return LETTER_WORD.findall(text)
+
+
+def _word_tokens(text):
+    return WORD_TOKEN.findall(text)
+
+
+def _cached(split, text, content_hash):
+    if len(text) < MIN_CACHED_LENGTH:
+        return split(text)
+    key = (split.__name__, content_hash or text_hash(text))
+    words = token_cache.get(key)
+    if words is None:
+        words = tuple(split(text))
+        token_cache.put(key, words)
+    # The callers are free to modify their list
+    return list(words)
+
+
+def split_words_from_text(text, content_hash=None):
+    """
+    :param content_hash: the text_hash of the text, if already known
+    :return: the list of the words of the text, the runs of letters
+    """
+    return _cached(_letter_words, text, content_hash)
+
+
+def split_word_tokens(text, content_hash=None):
+    """
+    :param content_hash: the text_hash of the text, if already known
+    :return: the list of the runs of letters, digits and underscores of the text
+    """
+    return _cached(_word_tokens, text, content_hash)